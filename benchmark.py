@@ -0,0 +1,466 @@
+'''
+benchmark of teslamate_fix_addrs.py, with fake nominatim and amap servers
+and a seeded benchmark database.
+'''
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine.url import URL
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from threading import Thread, Lock
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+parser = argparse.ArgumentParser(
+    description='Benchmark of address fixer, extra args after "--" are '
+    'passed to the fixer.')
+parser.add_argument("-u",
+                    "--user",
+                    required=False,
+                    type=str,
+                    default='postgres',
+                    help="db user name.")
+parser.add_argument("-p",
+                    "--password",
+                    required=False,
+                    type=str,
+                    default='postgres',
+                    help="db password.")
+parser.add_argument("-H",
+                    "--host",
+                    required=False,
+                    type=str,
+                    default='localhost',
+                    help="db host name or ip address.")
+parser.add_argument("-P",
+                    "--port",
+                    required=False,
+                    type=int,
+                    default=5432,
+                    help="db port.")
+parser.add_argument("-d",
+                    "--dbname",
+                    required=False,
+                    type=str,
+                    default='teslamate_fix_addrs_bench',
+                    help="benchmark db, it is dropped and created again, "
+                    "never use teslamate's db.")
+parser.add_argument("--scales",
+                    required=False,
+                    type=str,
+                    default='100,1000',
+                    help="numbers of drives to seed, separated by ','.")
+parser.add_argument("--modes",
+                    required=False,
+                    type=str,
+                    default='0,1,2',
+                    help="run modes to benchmark, separated by ','.")
+parser.add_argument("--latency",
+                    required=False,
+                    type=float,
+                    default=0.05,
+                    help="seconds of fake api response latency.")
+parser.add_argument("--error_rate",
+                    required=False,
+                    type=float,
+                    default=0,
+                    help="ratio of fake api responses failed by 500.")
+parser.add_argument("--rate_limit",
+                    required=False,
+                    type=float,
+                    default=0,
+                    help="requests per second of every fake api, more are "
+                    "refused, 0 means no limit.")
+parser.add_argument("--seed",
+                    required=False,
+                    type=int,
+                    default=1,
+                    help="random seed of data and fake api errors.")
+parser.add_argument("--output",
+                    required=False,
+                    type=str,
+                    default='',
+                    help="save results to this json file.")
+parser.add_argument("fixer_args", nargs=argparse.REMAINDER)
+args = parser.parse_args()
+
+fixer_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'teslamate_fix_addrs.py')
+# seeded positions are in shanghai, so amap converts all of them.
+seed_area = (31.0, 121.2, 31.4, 121.7)
+# positions of a location are rounded to this many decimal places.
+seed_precision = 4
+# tables used by fixer, in the shape of teslamate's.
+schema = '''
+CREATE TABLE schema_migrations (version bigint PRIMARY KEY,
+                                inserted_at timestamp);
+INSERT INTO schema_migrations VALUES (20240101000000, now());
+CREATE TABLE cars (id serial PRIMARY KEY, name text);
+INSERT INTO cars (name) VALUES ('bench');
+CREATE TABLE addresses (
+  id serial PRIMARY KEY, display_name varchar(512), latitude numeric(8,6),
+  longitude numeric(9,6), name varchar(255), house_number varchar(255),
+  road varchar(255), neighbourhood varchar(255), city varchar(255),
+  county varchar(255), postcode varchar(255), state varchar(255),
+  state_district varchar(255), country varchar(255), raw jsonb,
+  inserted_at timestamp NOT NULL, updated_at timestamp NOT NULL,
+  osm_id bigint, osm_type text);
+CREATE UNIQUE INDEX addresses_osm_id_osm_type_index
+  ON addresses (osm_id, osm_type);
+CREATE TABLE positions (id serial PRIMARY KEY, date timestamp NOT NULL,
+  latitude numeric(8,6) NOT NULL, longitude numeric(9,6) NOT NULL,
+  car_id int REFERENCES cars(id));
+CREATE TABLE drives (id serial PRIMARY KEY, start_date timestamp NOT NULL,
+  end_date timestamp, start_position_id int REFERENCES positions(id),
+  end_position_id int REFERENCES positions(id),
+  start_address_id int REFERENCES addresses(id),
+  end_address_id int REFERENCES addresses(id),
+  car_id int REFERENCES cars(id));
+CREATE TABLE charging_processes (id serial PRIMARY KEY,
+  start_date timestamp NOT NULL, end_date timestamp,
+  position_id int REFERENCES positions(id),
+  address_id int REFERENCES addresses(id), car_id int REFERENCES cars(id));
+'''
+
+
+class FakeApi:
+    '''fake nominatim and amap apis, with latency, errors and rate limit.'''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.random = random.Random(args.seed)
+        self.calls = {}
+        # token buckets of apis, allow requests of one second in a burst.
+        self.buckets = {}
+
+    def count(self, api):
+        '''count a call, return False if it is over rate limit.'''
+        now = time.monotonic()
+        with self.lock:
+            self.calls[api] = self.calls.get(api, 0) + 1
+            if args.rate_limit <= 0:
+                return True
+            burst = max(args.rate_limit, 1)
+            tokens, updated = self.buckets.get(api, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * args.rate_limit)
+            if tokens < 1:
+                self.buckets[api] = (tokens, now)
+                return False
+            self.buckets[api] = (tokens - 1, now)
+            return True
+
+    def failed(self):
+        with self.lock:
+            return self.random.random() < args.error_rate
+
+    def reset(self):
+        with self.lock:
+            calls = self.calls
+            self.calls = {}
+        return calls
+
+
+fake_api = FakeApi()
+
+
+def osm_id(lat, lon):
+    '''same place for the same rounded coordinate.'''
+    key = '%.4f,%.4f' % (float(lat), float(lon))
+    return int(hashlib.md5(key.encode()).hexdigest()[:8], 16)
+
+
+def fake_osm_reverse(query):
+    lat, lon = float(query['lat'][0]), float(query['lon'][0])
+    place = osm_id(lat, lon)
+    return {
+        'place_id': place,
+        'osm_type': 'way',
+        'osm_id': place,
+        'lat': '%.6f' % lat,
+        'lon': '%.6f' % lon,
+        'name': 'Place %d' % place,
+        'display_name': 'Place %d, Bench Road, Bench City, China' % place,
+        'address': {
+            'house_number': str(place % 1000),
+            'road': 'Bench Road',
+            'suburb': 'Bench District',
+            'city': 'Bench City',
+            'state': 'Bench State',
+            'postcode': '200000',
+            'country': 'China'
+        },
+        'namedetails': {}
+    }
+
+
+def fake_amap_convert(query):
+    locations = []
+    for location in query['locations'][0].split('|'):
+        lon, lat = location.split(',')
+        locations.append('%.6f,%.6f' % (float(lon) + 0.0045,
+                                        float(lat) - 0.002))
+    return {
+        'status': '1',
+        'info': 'ok',
+        'infocode': '10000',
+        'locations': ';'.join(locations)
+    }
+
+
+def fake_amap_regeo(query):
+    locations = query['location'][0].split('|')
+
+    def regeocode(location):
+        lon, lat = location.split(',')
+        return {
+            'formatted_address': '上海市浦东新区%s路%d号' %
+                                 (location, osm_id(lat, lon) % 1000),
+            'addressComponent': {
+                'country': '中国',
+                'province': '上海市',
+                'city': [],
+                'district': '浦东新区',
+                'township': '花木街道',
+                'neighborhood': {'name': []},
+                'streetNumber': {'number': '1号'}
+            },
+            'roads': [{'name': '世纪大道'}],
+            'aois': [],
+            'pois': [{'name': '世纪公园'}]
+        }
+
+    if query.get('batch', ['false'])[0] == 'true':
+        return {
+            'status': '1',
+            'info': 'OK',
+            'infocode': '10000',
+            'regeocodes': [regeocode(location) for location in locations]
+        }
+    return {
+        'status': '1',
+        'info': 'OK',
+        'infocode': '10000',
+        'regeocode': regeocode(locations[0])
+    }
+
+
+fake_apis = {
+    '/reverse': ('osm', fake_osm_reverse),
+    '/v3/assistant/coordinate/convert': ('amap_convert', fake_amap_convert),
+    '/v3/geocode/regeo': ('amap_regeo', fake_amap_regeo),
+}
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path not in fake_apis:
+            self.reply(404, {})
+            return
+        api, fake = fake_apis[url.path]
+        time.sleep(args.latency)
+        if not fake_api.count(api):
+            if api == 'osm':
+                self.reply(429, {'error': 'rate limited'})
+            else:
+                # amap responds over limit in body.
+                self.reply(200, {
+                    'status': '0',
+                    'info': 'CUQPS_HAS_EXCEEDED_THE_LIMIT',
+                    'infocode': '10019'
+                })
+            return
+        if fake_api.failed():
+            self.reply(500, {'error': 'fake error'})
+            return
+        self.reply(200, fake(parse_qs(url.query)))
+
+    def reply(self, code, body):
+        data = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # requests are not logged.
+        pass
+
+
+def start_fake_server():
+    '''start fake apis in background, return base url.'''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeApiHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+def get_db_url(dbname):
+    return URL.create(drivername="postgresql",
+                      username=args.user,
+                      password=args.password,
+                      host=args.host,
+                      port=args.port,
+                      database=dbname)
+
+
+def create_db():
+    '''drop and create benchmark db.'''
+    if args.dbname == 'teslamate':
+        raise SystemExit("benchmark db is dropped, do not use teslamate.")
+    engine = create_engine(get_db_url('postgres'),
+                           isolation_level='AUTOCOMMIT')
+    with engine.connect() as connection:
+        connection.execute(text('DROP DATABASE IF EXISTS "%s"' % args.dbname))
+        connection.execute(text('CREATE DATABASE "%s"' % args.dbname))
+    engine.dispose()
+
+
+def seed_db(scale):
+    '''
+    create tables and seed scale drives with empty addresses, half as many
+    charging processes, and scale addresses for amap to update.
+    '''
+    create_db()
+    rand = random.Random(args.seed)
+    engine = create_engine(get_db_url(args.dbname))
+
+    def random_position():
+        # places are revisited, like home and work.
+        return (round(rand.uniform(seed_area[0], seed_area[2]), seed_precision),
+                round(rand.uniform(seed_area[1], seed_area[3]), seed_precision))
+
+    places = [random_position() for _ in range(max(scale // 2, 1))]
+    charging_count = scale // 2
+    positions = [rand.choice(places) for _ in range(scale * 2 + charging_count)]
+    with engine.begin() as connection:
+        for statement in schema.split(';'):
+            if statement.strip():
+                connection.execute(text(statement))
+        connection.execute(
+            text('''INSERT INTO positions (date, latitude, longitude, car_id)
+                    VALUES (now(), :latitude, :longitude, 1)'''),
+            [{'latitude': lat, 'longitude': lon} for lat, lon in positions])
+        connection.execute(
+            text('''INSERT INTO drives (start_date, start_position_id,
+                                        end_position_id, car_id)
+                    SELECT now(), g * 2 - 1, g * 2, 1
+                    FROM generate_series(1, :count) g'''), {'count': scale})
+        connection.execute(
+            text('''INSERT INTO charging_processes (start_date, position_id,
+                                                    car_id)
+                    SELECT now(), :drive_positions + g, 1
+                    FROM generate_series(1, :count) g'''), {
+                'drive_positions': scale * 2,
+                'count': charging_count
+            })
+        connection.execute(
+            text('''INSERT INTO addresses (display_name, latitude, longitude,
+                                           osm_id, osm_type, inserted_at,
+                                           updated_at)
+                    VALUES (:display_name, :latitude, :longitude, :osm_id,
+                            'node', now(), now())'''),
+            [{
+                'display_name': 'Seed %d' % i,
+                'latitude': lat,
+                'longitude': lon,
+                'osm_id': i
+            } for i, (lat, lon) in enumerate(places[:scale], 1)])
+    engine.dispose()
+
+
+def count_records():
+    '''fixed records and updated addresses.'''
+    engine = create_engine(get_db_url(args.dbname))
+    with engine.connect() as connection:
+        fixed = connection.execute(
+            text('''SELECT (SELECT count(*) FROM drives
+                            WHERE start_address_id IS NOT NULL
+                            AND end_address_id IS NOT NULL) +
+                           (SELECT count(*) FROM charging_processes
+                            WHERE address_id IS NOT NULL)''')).scalar()
+        updated = connection.execute(
+            text('''SELECT count(*) FROM addresses
+                    WHERE display_name LIKE '上海市%' ''')).scalar()
+    engine.dispose()
+    return fixed, updated
+
+
+def run_fixer(mode, base_url):
+    '''run fixer once, return seconds, exit code and peak rss in KB.'''
+    fixer_args = [a for a in args.fixer_args if a != '--']
+    command = [
+        sys.executable, fixer_path, '-u', args.user, '-p', args.password,
+        '-H', args.host, '-P', str(args.port), '-d', args.dbname, '-m',
+        str(mode), '-k', 'bench', '--osm_url', base_url, '--amap_url',
+        base_url, '--osm_qps', '0', '--amap_qps', '0'
+    ] + fixer_args
+    start = time.monotonic()
+    process = subprocess.Popen(command,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    # rusage of this child only.
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return time.monotonic() - start, process.returncode, usage.ru_maxrss
+
+
+def main():
+    base_url = start_fake_server()
+    results = []
+    for scale in [int(s) for s in args.scales.split(',')]:
+        for mode in [int(m) for m in args.modes.split(',')]:
+            logging.info("seeding %d drives for mode %d..." % (scale, mode))
+            seed_db(scale)
+            fixed_before, updated_before = count_records()
+            fake_api.reset()
+            seconds, code, rss = run_fixer(mode, base_url)
+            calls = fake_api.reset()
+            fixed, updated = count_records()
+            records = fixed - fixed_before + updated - updated_before
+            result = {
+                'scale': scale,
+                'mode': mode,
+                'exit_code': code,
+                'seconds': round(seconds, 3),
+                'records': records,
+                'records_per_second':
+                    round(records / seconds, 2) if seconds > 0 else 0,
+                'api_calls': sum(calls.values()),
+                'api_calls_per_record':
+                    round(sum(calls.values()) / records, 3)
+                    if records > 0 else 0,
+                'api_calls_by_provider': calls,
+                'peak_rss_kb': rss
+            }
+            logging.info("%s" % json.dumps(result))
+            results.append(result)
+
+    print('%8s %4s %9s %8s %10s %14s %12s' %
+          ('scale', 'mode', 'seconds', 'records', 'records/s',
+           'calls/record', 'peak rss KB'))
+    for result in results:
+        print('%8d %4d %9.3f %8d %10.2f %14.3f %12d' %
+              (result['scale'], result['mode'], result['seconds'],
+               result['records'], result['records_per_second'],
+               result['api_calls_per_record'], result['peak_rss_kb']))
+    if len(args.output) > 0:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
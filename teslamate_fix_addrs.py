@@ -1,16 +1,27 @@
 from sqlalchemy.ext.automap import automap_base
-from sqlalchemy.orm import Session
-from sqlalchemy import create_engine, or_, func
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy import event, create_engine, or_, and_, case, func, select, update, delete, union_all, tuple_, values, column, text, Integer, BigInteger, Numeric, String, Date, DateTime, Boolean, MetaData, Table, Column
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.engine.url import URL
-import requests
-from requests.adapters import HTTPAdapter
 import json
-from datetime import datetime
+import math
+import mmap
+import struct
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
 import logging
 import argparse
+import atexit
+import hashlib
+from urllib.parse import urlparse
+from contextlib import contextmanager
+from collections import namedtuple, deque
 import os
+import pickle
+import queue
+import select as select_fd
 import signal
-from threading import Timer
+from threading import Timer, Lock, RLock, Thread, local
 import time
 
 logging.basicConfig(
@@ -24,6 +35,7 @@ logging.basicConfig(
 def handler(signum, frame):
     '''Contrl-C handler.'''
     logging.info("Ctrl-C pressed, exit.")
+    report_profile()
     os._exit(0)
 
 
@@ -106,6 +118,20 @@ parser.add_argument("-r",
                     action=EnvDefault,
                     envvar="HTTP_RETRY",
                     help="http request max retries(HTTP_RETRY).")
+parser.add_argument("--pool_size",
+                    required=False,
+                    type=int,
+                    default=10,
+                    action=EnvDefault,
+                    envvar="HTTP_POOL_SIZE",
+                    help="http keep-alive connections per host(HTTP_POOL_SIZE).")
+parser.add_argument("--backoff",
+                    required=False,
+                    type=float,
+                    default=0.5,
+                    action=EnvDefault,
+                    envvar="HTTP_BACKOFF",
+                    help="http retry backoff factor(s)(HTTP_BACKOFF).")
 parser.add_argument(
     "-i",
     "--interval",
@@ -135,7 +161,7 @@ parser.add_argument("-k",
                     default='',
                     action=EnvDefault,
                     envvar="KEY",
-                    help="API key for calling amap(KEY).")
+                    help="API keys for calling amap, separated by ','(KEY).")
 
 parser.add_argument("-s",
                     "--since",
@@ -155,6 +181,232 @@ parser.add_argument(
     envvar="USER_AGENT",
     help="Custom User-Agent for HTTP requests(USER_AGENT)."
 )
+parser.add_argument("-c",
+                    "--cache",
+                    required=False,
+                    type=str,
+                    default='',
+                    action=EnvDefault,
+                    envvar="CACHE_FILE",
+                    help="geocode response cache file, empty to disable(CACHE_FILE).")
+parser.add_argument("--cache_ttl",
+                    required=False,
+                    type=int,
+                    default=30,
+                    action=EnvDefault,
+                    envvar="CACHE_TTL",
+                    help="days before a cached response expires(CACHE_TTL).")
+parser.add_argument("--cache_size",
+                    required=False,
+                    type=int,
+                    default=100000,
+                    action=EnvDefault,
+                    envvar="CACHE_SIZE",
+                    help="max cached responses, least recently used are evicted(CACHE_SIZE).")
+parser.add_argument("--cache_precision",
+                    required=False,
+                    type=int,
+                    default=6,
+                    action=EnvDefault,
+                    envvar="CACHE_PRECISION",
+                    help="decimal places of lat/lon used as cache key(CACHE_PRECISION).")
+parser.add_argument("--reuse_radius",
+                    required=False,
+                    type=float,
+                    default=0,
+                    action=EnvDefault,
+                    envvar="REUSE_RADIUS",
+                    help="reuse known address within this radius(m) instead of calling api, 0 to disable(REUSE_RADIUS).")
+parser.add_argument("--concurrency",
+                    required=False,
+                    type=int,
+                    default=1,
+                    action=EnvDefault,
+                    envvar="CONCURRENCY",
+                    help="concurrent geocoding requests in one batch(CONCURRENCY).")
+parser.add_argument("--osm_qps",
+                    required=False,
+                    type=float,
+                    default=1,
+                    action=EnvDefault,
+                    envvar="OSM_QPS",
+                    help="max open street map requests per second, 0 for no limit(OSM_QPS).")
+parser.add_argument("--amap_qps",
+                    required=False,
+                    type=float,
+                    default=3,
+                    action=EnvDefault,
+                    envvar="AMAP_QPS",
+                    help="max amap requests per second, 0 for no limit(AMAP_QPS).")
+parser.add_argument("--group_precision",
+                    required=False,
+                    type=int,
+                    default=0,
+                    action=EnvDefault,
+                    envvar="GROUP_PRECISION",
+                    help="if value not 0, fix records grouped by lat/lon rounded to these decimal places, one request per group(GROUP_PRECISION).")
+parser.add_argument("--amap_batch",
+                    required=False,
+                    type=int,
+                    default=0,
+                    action=EnvDefault,
+                    envvar="AMAP_BATCH",
+                    help="if value not 0, use amap batch apis, up to 40 converts and 20 regeos in one request(AMAP_BATCH).")
+parser.add_argument("--coord_convert",
+                    required=False,
+                    type=str,
+                    default='local',
+                    choices=['local', 'remote', 'validate'],
+                    action=EnvDefault,
+                    envvar="COORD_CONVERT",
+                    help="convert gps coordinate to amap coordinate: local -> convert locally; remote -> by amap api; validate -> both and use amap api result(COORD_CONVERT).")
+parser.add_argument("--metadata_cache",
+                    required=False,
+                    type=str,
+                    default='',
+                    action=EnvDefault,
+                    envvar="METADATA_CACHE",
+                    help="reflected tables cache file, empty to disable(METADATA_CACHE).")
+parser.add_argument("--daemon",
+                    required=False,
+                    type=int,
+                    default=0,
+                    action=EnvDefault,
+                    envvar="DAEMON",
+                    help="if value not 0, run as daemon, fix records when notified by db(DAEMON).")
+parser.add_argument("--sweep",
+                    required=False,
+                    type=int,
+                    default=3600,
+                    action=EnvDefault,
+                    envvar="SWEEP",
+                    help="in daemon mode, check all records in every sweep seconds(SWEEP).")
+parser.add_argument("--install_trigger",
+                    required=False,
+                    type=int,
+                    default=0,
+                    action=EnvDefault,
+                    envvar="INSTALL_TRIGGER",
+                    help="if value not 0, install db triggers which notify daemon(INSTALL_TRIGGER).")
+parser.add_argument("--reset_checkpoint",
+                    required=False,
+                    type=int,
+                    default=0,
+                    action=EnvDefault,
+                    envvar="RESET_CHECKPOINT",
+                    help="if value not 0, forget amap update progress and update all addresses since SINCE again(RESET_CHECKPOINT).")
+parser.add_argument("--pipeline",
+                    required=False,
+                    type=int,
+                    default=0,
+                    action=EnvDefault,
+                    envvar="PIPELINE",
+                    help="if value not 0, read, resolve and save records concurrently(PIPELINE).")
+parser.add_argument("--metrics_port",
+                    required=False,
+                    type=int,
+                    default=0,
+                    action=EnvDefault,
+                    envvar="METRICS_PORT",
+                    help="serve prometheus metrics on this port, 0 means disabled(METRICS_PORT).")
+parser.add_argument("--osm_url",
+                    required=False,
+                    type=str,
+                    default='https://nominatim.openstreetmap.org',
+                    action=EnvDefault,
+                    envvar="OSM_URL",
+                    help="base urls of nominatim api, separated by ','(OSM_URL).")
+parser.add_argument("--amap_url",
+                    required=False,
+                    type=str,
+                    default='https://restapi.amap.com',
+                    action=EnvDefault,
+                    envvar="AMAP_URL",
+                    help="base url of amap api(AMAP_URL).")
+parser.add_argument("--offline_index",
+                    required=False,
+                    type=str,
+                    default='',
+                    action=EnvDefault,
+                    envvar="OFFLINE_INDEX",
+                    help="resolve positions by this offline index instead of open street map(OFFLINE_INDEX).")
+parser.add_argument("--offline_build",
+                    required=False,
+                    type=str,
+                    default='',
+                    action=EnvDefault,
+                    envvar="OFFLINE_BUILD",
+                    help="build OFFLINE_INDEX from this geonames file and exit(OFFLINE_BUILD).")
+parser.add_argument("--profile",
+                    required=False,
+                    type=int,
+                    default=0,
+                    action=EnvDefault,
+                    envvar="PROFILE",
+                    help="if value not 0, log time spent in every stage at exit(PROFILE).")
+parser.add_argument("--profile_output",
+                    required=False,
+                    type=str,
+                    default='',
+                    action=EnvDefault,
+                    envvar="PROFILE_OUTPUT",
+                    help="save cProfile stats to this file at exit, PROFILE must be set(PROFILE_OUTPUT).")
+parser.add_argument("--hedge_delay",
+                    required=False,
+                    type=float,
+                    default=2,
+                    action=EnvDefault,
+                    envvar="HEDGE_DELAY",
+                    help="seconds to wait before requesting next OSM_URL too, 0 means only on errors(HEDGE_DELAY).")
+parser.add_argument("--breaker_failures",
+                    required=False,
+                    type=int,
+                    default=5,
+                    action=EnvDefault,
+                    envvar="BREAKER_FAILURES",
+                    help="pause a map api after this many failures in a row, 0 means never(BREAKER_FAILURES).")
+parser.add_argument("--breaker_pause",
+                    required=False,
+                    type=float,
+                    default=60,
+                    action=EnvDefault,
+                    envvar="BREAKER_PAUSE",
+                    help="seconds to pause a failing map api(BREAKER_PAUSE).")
+parser.add_argument("--claim",
+                    required=False,
+                    type=int,
+                    default=0,
+                    action=EnvDefault,
+                    envvar="CLAIM",
+                    help="if value not 0, lock records of a batch, so more fixers can run at the same time(CLAIM).")
+parser.add_argument("--amap_daily_quota",
+                    required=False,
+                    type=int,
+                    default=0,
+                    action=EnvDefault,
+                    envvar="AMAP_DAILY_QUOTA",
+                    help="max requests of every amap key per day, 0 means no limit(AMAP_DAILY_QUOTA).")
+parser.add_argument("--retry_backoff",
+                    required=False,
+                    type=float,
+                    default=3600,
+                    action=EnvDefault,
+                    envvar="RETRY_BACKOFF",
+                    help="seconds before retrying a failed record, doubled after every failure, 0 means retry at once(RETRY_BACKOFF).")
+parser.add_argument("--fresh_window",
+                    required=False,
+                    type=float,
+                    default=0,
+                    action=EnvDefault,
+                    envvar="FRESH_WINDOW",
+                    help="drives and charging processes started in this seconds are fixed before older ones, 0 means disabled(FRESH_WINDOW).")
+parser.add_argument("--fresh_share",
+                    required=False,
+                    type=float,
+                    default=0.5,
+                    action=EnvDefault,
+                    envvar="FRESH_SHARE",
+                    help="share of every batch reserved for fresh records of FRESH_WINDOW(FRESH_SHARE).")
 args = parser.parse_args()
 
 
@@ -171,25 +423,404 @@ conn_url = URL.create(
     database=args.dbname
 )
 
-engine = create_engine(conn_url, json_serializer=custom_json_dumps, echo=False)
+engine = None
 
 # open street map api.
-osm_resolve_url = "https://nominatim.openstreetmap.org/reverse?lat=%.6f&lon=%.6f&format=jsonv2&addressdetails=1&extratags=1&namedetails=1&zoom=18"
-
-# amap api.
-amap_coordinate_transformation_url = "https://restapi.amap.com/v3/assistant/coordinate/convert?key=%s&coordsys=gps&output=json&locations=%s,%s"
-amap_resolve_url = "https://restapi.amap.com/v3/geocode/regeo?key=%s&output=json&location=%s,%s&poitype=all&extensions=all"
+osm_urls = [url.strip().rstrip('/') for url in args.osm_url.split(',')]
+osm_resolve_path = "/reverse?lat=%.6f&lon=%.6f&format=jsonv2&addressdetails=1&extratags=1&namedetails=1&zoom=18"
+
+# amap api, key is appended to url when requested.
+amap_coordinate_transformation_url = args.amap_url.rstrip('/') + "/v3/assistant/coordinate/convert?coordsys=gps&output=json&locations=%s,%s"
+amap_resolve_url = args.amap_url.rstrip('/') + "/v3/geocode/regeo?output=json&location=%s,%s&poitype=all&extensions=all"
+# amap batch api, locations are separated by '|'.
+amap_batch_coordinate_transformation_url = args.amap_url.rstrip('/') + "/v3/assistant/coordinate/convert?coordsys=gps&output=json&locations=%s"
+amap_batch_resolve_url = args.amap_url.rstrip('/') + "/v3/geocode/regeo?output=json&location=%s&poitype=all&extensions=all&batch=true"
+amap_batch_convert_size = 40
+amap_batch_resolve_size = 20
+# amap infocodes of too many requests, retry later.
+amap_rate_infocodes = ['10004', '10014', '10019', '10020', '10021']
+# amap infocodes of daily quota used up.
+amap_quota_infocodes = ['10003', '10044']
+# amap infocodes of invalid requests, such as coordinates out of service.
+amap_invalid_infocodes = ['20000', '20001', '20800', '20801', '20802', '20803']
+
+# rate is increased by this ratio of max rate after a success, and
+# multiplied by decrease ratio if over limit, but not below min ratio.
+aimd_increase = 0.05
+aimd_decrease = 0.5
+aimd_min = 0.05
+
+# krasovsky 1940 ellipsoid, used by gcj-02.
+gcj02_a = 6378245.0
+gcj02_ee = 0.00669342162296594323
+# max distance(m) between local and remote converted coordinates.
+convert_tolerance = 1.0
+
+# name of amap update progress.
+amap_checkpoint = 'amap'
+
+# fixer's own tables, created if not exist.
+state_metadata = MetaData()
+# progress of updating, all addresses which id is not greater than last_id
+# and updated before watermark are processed.
+checkpoints = Table('teslamate_fix_addrs_checkpoints', state_metadata,
+                    Column('name', String(64), primary_key=True),
+                    Column('last_id', BigInteger, nullable=False),
+                    Column('watermark', DateTime, nullable=False))
+# usage of amap keys today, keys are saved as sha256 hash.
+amap_key_usages = Table('teslamate_fix_addrs_amap_keys', state_metadata,
+                        Column('key_hash', String(64), primary_key=True),
+                        Column('day', Date, nullable=False),
+                        Column('used', Integer, nullable=False),
+                        Column('exhausted', Boolean, nullable=False))
+# fingerprint of last amap result of an address, and updated_at of the
+# address then. addresses not changed since are not resolved again.
+amap_fingerprints = Table('teslamate_fix_addrs_amap_fingerprints',
+                          state_metadata,
+                          Column('address_id', BigInteger, primary_key=True),
+                          Column('fingerprint', String(64), nullable=False),
+                          Column('updated_at', DateTime, nullable=False))
+
+# records failed to resolve, not selected again until next_attempt_at.
+failures = Table('teslamate_fix_addrs_failures', state_metadata,
+                 Column('kind', String(16), primary_key=True),
+                 Column('record_id', BigInteger, primary_key=True),
+                 Column('error', String(64), nullable=False),
+                 Column('attempts', Integer, nullable=False),
+                 Column('next_attempt_at', DateTime, nullable=False))
+# max seconds between retries of a failed record.
+retry_backoff_max = 7 * 24 * 3600
+
+# daemon is notified on this channel, also name of triggers.
+notify_channel = 'teslamate_fix_addrs'
+# tables and conditions that notify daemon.
+notify_triggers = [
+    ('drives', 'NEW.end_position_id IS NOT NULL AND '
+     '(NEW.start_address_id IS NULL OR NEW.end_address_id IS NULL)'),
+    ('charging_processes', 'NEW.address_id IS NULL'),
+    ('addresses', 'TRUE'),
+]
+# seconds to wait for more notifies before fixing.
+notify_delay = 1
+# seconds to wait for more results before saving a partial batch in pipeline.
+pipeline_flush_interval = 1
+
+# prefix of metric names.
+metrics_prefix = 'teslamate_fix_addrs_'
+# upper bounds of duration histograms, in seconds.
+metrics_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+metrics_help = {
+    'records_total': ('counter', 'records fixed or updated.'),
+    'backlog': ('gauge', 'records left to fix or update.'),
+    'http_request_seconds': ('histogram', 'map api request duration.'),
+    'http_retries_total': ('counter', 'map api requests retried.'),
+    'cache_requests_total': ('counter', 'response cache lookups by result.'),
+    'db_query_seconds': ('histogram', 'db statement duration.'),
+    'db_commit_seconds': ('histogram', 'db commit duration.'),
+    'queue_size': ('gauge', 'records waiting in pipeline queue.'),
+    'request_rate': ('gauge', 'current max requests per second of map api.'),
+    'throttled_total': ('counter', 'map api responses over rate limit.'),
+    'circuit_open_total': ('counter', 'map api paused after failures.'),
+    'failures_total': ('counter', 'records failed to resolve, retried later.'),
+}
+
+
+class Metrics:
+    '''counters, gauges and histograms in prometheus text format.'''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.values = {}
+        self.functions = {}
+        self.histograms = {}
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, name, function, labels=None):
+        '''gauge which value is got by function when collected.'''
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.functions[key] = function
+
+    def observe(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # bucket counts, sum and count.
+                histogram = [[0] * len(metrics_buckets), 0.0, 0]
+                self.histograms[key] = histogram
+            for i, bound in enumerate(metrics_buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        '''all metrics in prometheus text format.'''
+        def format_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if len(labels) == 0:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (k, v) for k, v in labels)
+
+        with self.lock:
+            samples = {}
+            for (name, labels), value in self.values.items():
+                samples.setdefault(name, []).append(
+                    '%s%s%s %s' % (metrics_prefix, name, format_labels(labels),
+                                   value))
+            for (name, labels), function in self.functions.items():
+                samples.setdefault(name, []).append(
+                    '%s%s%s %s' % (metrics_prefix, name, format_labels(labels),
+                                   function()))
+            for (name, labels), (buckets, total, count) in \
+                    self.histograms.items():
+                lines = samples.setdefault(name, [])
+                for bound, bucket in zip(metrics_buckets, buckets):
+                    lines.append('%s%s_bucket%s %d' %
+                                 (metrics_prefix, name,
+                                  format_labels(labels, [('le', bound)]),
+                                  bucket))
+                lines.append('%s%s_bucket%s %d' %
+                             (metrics_prefix, name,
+                              format_labels(labels, [('le', '+Inf')]), count))
+                lines.append('%s%s_sum%s %s' % (metrics_prefix, name,
+                                                format_labels(labels), total))
+                lines.append('%s%s_count%s %d' %
+                             (metrics_prefix, name, format_labels(labels),
+                              count))
+        output = []
+        for name, lines in sorted(samples.items()):
+            metric_type, metric_help = metrics_help[name]
+            output.append('# HELP %s%s %s' % (metrics_prefix, name, metric_help))
+            output.append('# TYPE %s%s %s' % (metrics_prefix, name, metric_type))
+            output.extend(lines)
+        return '\n'.join(output) + '\n'
+
+
+metrics = Metrics()
+metrics_server = None
+
+
+def start_metrics_server():
+    '''serve metrics by http in background, only once.'''
+    global metrics_server
+    if args.metrics_port == 0 or metrics_server is not None:
+        return
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # requests are not logged.
+            pass
+
+    metrics_server = ThreadingHTTPServer(('', args.metrics_port),
+                                         MetricsHandler)
+    Thread(target=metrics_server.serve_forever, daemon=True).start()
+    logging.info("serving metrics on port %d." % args.metrics_port)
+
+
+# count and seconds of every stage, by name. reentrant, Ctrl-C handler reports
+# profile on main thread, which may be holding it.
+stage_times = {}
+stage_lock = RLock()
+profiler = None
+profile_start = time.monotonic()
+
+
+def add_stage_time(name, seconds):
+    with stage_lock:
+        count, total, longest = stage_times.get(name, (0, 0.0, 0.0))
+        stage_times[name] = (count + 1, total + seconds, max(longest, seconds))
+
+
+@contextmanager
+def profile_stage(name):
+    '''time a block as stage if profile is set.'''
+    if args.profile == 0:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        add_stage_time(name, time.monotonic() - start)
 
-# last updated record id.
-last_update_id = 0
 
-# reflact Objects from db tables.
-Base = automap_base()
-Base.prepare(autoload_with=engine)
-Drives = Base.classes.drives
-ChargingProcesses = Base.classes.charging_processes
-Positions = Base.classes.positions
-Addresses = Base.classes.addresses
+def profiled(name):
+    '''time every call of function as stage if profile is set.'''
+
+    def decorator(function):
+        if args.profile == 0:
+            return function
+
+        def wrapper(*call_args, **call_kwargs):
+            with profile_stage(name):
+                return function(*call_args, **call_kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def start_profile():
+    '''profile main thread by cProfile if profile output is set.'''
+    global profiler
+    if args.profile == 0 or len(args.profile_output) == 0 or \
+            profiler is not None:
+        return
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+
+def report_profile():
+    '''log stage times, and save cProfile stats.'''
+    if args.profile == 0:
+        return
+    elapsed = time.monotonic() - profile_start
+    logging.info("profile of %.3f seconds:" % elapsed)
+    logging.info("%-16s %8s %10s %10s %10s %6s" %
+                 ('stage', 'count', 'total(s)', 'mean(ms)', 'max(ms)', '%'))
+    with stage_lock:
+        stages = sorted(stage_times.items(), key=lambda stage: -stage[1][1])
+    for name, (count, total, longest) in stages:
+        # stages in worker threads may overlap, so sum is not elapsed.
+        logging.info("%-16s %8d %10.3f %10.2f %10.2f %6.1f" %
+                     (name, count, total, total * 1000 / count,
+                      longest * 1000, total * 100 / elapsed))
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile_output)
+        logging.info("cProfile stats are saved to %s." % args.profile_output)
+
+
+atexit.register(report_profile)
+
+
+def watch_db_durations():
+    '''observe durations of db statements and commits.'''
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault('query_start', []).append(time.monotonic())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        metrics.observe('db_query_seconds',
+                        time.monotonic() - conn.info['query_start'].pop())
+
+    def before_commit(session):
+        session.info['commit_start'] = time.monotonic()
+
+    def after_commit(session):
+        if 'commit_start' in session.info:
+            seconds = time.monotonic() - session.info.pop('commit_start')
+            metrics.observe('db_commit_seconds', seconds)
+            if args.profile != 0:
+                add_stage_time('commit', seconds)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(Session, 'before_commit', before_commit)
+    event.listen(Session, 'after_commit', after_commit)
+
+
+# tables used by fixer, other teslamate tables are not reflected.
+reflected_tables = ['drives', 'charging_processes', 'positions', 'addresses']
+
+# Objects of db tables, reflected by init_db.
+Drives = None
+ChargingProcesses = None
+Positions = None
+Addresses = None
+
+
+def get_schema_version():
+    '''teslamate schema version, which is the latest migration.'''
+    with engine.connect() as connection:
+        return connection.execute(
+            text("SELECT max(version) FROM schema_migrations")).scalar()
+
+
+def reflect_metadata():
+    '''reflect used tables, cached metadata is used if schema not changed.'''
+    version = get_schema_version()
+    if len(args.metadata_cache) > 0 and os.path.exists(args.metadata_cache):
+        try:
+            with open(args.metadata_cache, 'rb') as f:
+                cached = pickle.load(f)
+            if cached['version'] == version:
+                return cached['metadata']
+            logging.info("schema changed, reflect tables again.")
+        except Exception:
+            logging.warning("metadata cache %s is broken, ignored." %
+                            args.metadata_cache)
+
+    metadata = MetaData()
+    metadata.reflect(engine, only=reflected_tables, resolve_fks=False)
+    # add referenced tables (such as cars) with primary keys only, so foreign
+    # keys can be resolved without reflecting them.
+    referenced_columns = {}
+    for table in list(metadata.tables.values()):
+        for foreign_key in table.foreign_keys:
+            table_name, column_name = foreign_key.target_fullname.split('.')[-2:]
+            if table_name not in metadata.tables:
+                referenced_columns.setdefault(table_name, set()).add(column_name)
+    for table_name, column_names in referenced_columns.items():
+        Table(table_name, metadata,
+              *[Column(column_name, Integer, primary_key=True)
+                for column_name in column_names])
+
+    if len(args.metadata_cache) > 0:
+        with open(args.metadata_cache, 'wb') as f:
+            pickle.dump({'version': version, 'metadata': metadata}, f)
+    return metadata
+
+
+def init_db():
+    '''create engine and reflact Objects from db tables, only once.'''
+    global engine, Drives, ChargingProcesses, Positions, Addresses
+    if engine is not None:
+        return
+    engine = create_engine(conn_url,
+                           json_serializer=custom_json_dumps,
+                           echo=False)
+    if args.metrics_port != 0 or args.profile != 0:
+        watch_db_durations()
+    with profile_stage('reflection'):
+        Base = automap_base(metadata=reflect_metadata())
+        Base.prepare()
+    Drives = Base.classes.drives
+    ChargingProcesses = Base.classes.charging_processes
+    Positions = Base.classes.positions
+    Addresses = Base.classes.addresses
+    state_metadata.create_all(engine)
+    amap_keys.load()
+    if args.reset_checkpoint != 0:
+        with Session(engine) as session:
+            reset_checkpoint(session, amap_checkpoint)
+            session.commit()
+        logging.info("amap update progress is reset.")
 
 # reference to teslamate's source code, get address value from multiple keys.
 house_number_aliases = ['house_number', 'street_number']
@@ -252,24 +883,452 @@ def get_address_name(address):
     return name
 
 
-def get_position(session, position_id):
-    '''get position id from table positions by position_ids.'''
-    position = session.query(Positions).filter(
-        Positions.id == position_id).first()
-    # position_id is foreign key to table positions. position will never be None.
-    if position == None:
-        # fatal error, exit now.
-        logging.fatal("Position with ID %s is not found." % position_id)
-        assert (False)
-    return position
+class AddressIndex:
+    '''grid index over known addresses, find nearby address without api.'''
+
+    def __init__(self, radius):
+        self.radius = radius
+        # cell size in latitude degrees, cells are square in degrees.
+        self.cell = radius / 111320.0
+        self.grid = {}
+        self.max_id = 0
+        # addresses are added while searching in pipeline mode.
+        self.lock = Lock()
+
+    def add(self, address_id, display_name, lat, lon):
+        '''add an address into index.'''
+        lat = float(lat)
+        lon = float(lon)
+        key = (int(lat // self.cell), int(lon // self.cell))
+        with self.lock:
+            self.grid.setdefault(key, {})[address_id] = (address_id,
+                                                         display_name, lat,
+                                                         lon)
+
+    def nearest(self, lat, lon):
+        '''return nearest address id and display_name within radius.'''
+        lat = float(lat)
+        lon = float(lon)
+        cos_lat = max(math.cos(math.radians(lat)), 0.01)
+        lat_span = 1
+        # longitude degrees get shorter far from equator.
+        lon_span = int(math.ceil(1 / cos_lat))
+        row = int(lat // self.cell)
+        col = int(lon // self.cell)
+        best = None
+        best_dist = self.radius
+        candidates = []
+        with self.lock:
+            for i in range(row - lat_span, row + lat_span + 1):
+                for j in range(col - lon_span, col + lon_span + 1):
+                    candidates.extend(self.grid.get((i, j), {}).values())
+        for address in candidates:
+            dist = distance(lat, lon, address[2], address[3])
+            if dist <= best_dist:
+                best = address
+                best_dist = dist
+        if best is None:
+            return None
+        return best[0], best[1]
+
 
+def distance(lat1, lon1, lat2, lon2):
+    '''haversine distance in meters.'''
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2)**2 + \
+        math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2)**2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
 
-def http_request(url):
-    '''get response by calling map api.'''
-    http_session = requests.Session()
-    http_session.mount('http://', HTTPAdapter(max_retries=args.retry))
-    http_session.mount('https://', HTTPAdapter(max_retries=args.retry))
-    headers = {
+
+# known addresses, loaded before fixing if reuse radius is set.
+address_index = AddressIndex(args.reuse_radius) if args.reuse_radius > 0 else None
+
+
+def load_address_index(session):
+    '''load addresses which are not indexed yet.'''
+    if address_index is None:
+        return
+    addresses = session\
+        .query(Addresses.id, Addresses.display_name, Addresses.latitude, Addresses.longitude)\
+        .filter(Addresses.id > address_index.max_id)\
+        .filter(Addresses.latitude.is_not(None))\
+        .filter(Addresses.longitude.is_not(None))\
+        .all()
+    for address in addresses:
+        address_index.add(address.id, address.display_name, address.latitude,
+                          address.longitude)
+        address_index.max_id = max(address_index.max_id, address.id)
+    logging.info("%d addresses loaded into index." % len(addresses))
+
+
+# offline index file: header, cell keys, latitudes, longitudes, place
+# offsets and places in json.
+offline_index_magic = b'TFAOFF01'
+offline_index_header = struct.Struct('<8sqq')
+# cell size of offline index in degrees.
+offline_cell = 0.1
+# geonames feature class of cities, villages and other populated places.
+offline_feature_class = 'P'
+
+
+def offline_cell_key(row, col):
+    '''cell key of offline index, longitude cells wrap around.'''
+    return row * int(360 / offline_cell) + col % int(360 / offline_cell)
+
+
+def load_geonames_names(path, key_columns):
+    '''load code to name dict from a geonames file, empty if not exists.'''
+    names = {}
+    if not os.path.exists(path):
+        return names
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) > max(key_columns):
+                names[fields[key_columns[0]]] = fields[key_columns[1]]
+    return names
+
+
+def build_offline_index(source, path):
+    '''
+    build offline index from geonames dump, such as cities500.txt.
+    admin1CodesASCII.txt, admin2Codes.txt and countryInfo.txt in the same
+    directory are used for state, county and country names.
+    '''
+    directory = os.path.dirname(os.path.abspath(source))
+    states = load_geonames_names(
+        os.path.join(directory, 'admin1CodesASCII.txt'), (0, 1))
+    counties = load_geonames_names(os.path.join(directory, 'admin2Codes.txt'),
+                                   (0, 1))
+    countries = load_geonames_names(os.path.join(directory, 'countryInfo.txt'),
+                                    (0, 4))
+
+    places = []
+    with open(source, encoding='utf-8') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 12 or fields[6] != offline_feature_class:
+                continue
+            lat = float(fields[4])
+            lon = float(fields[5])
+            country_code = fields[8]
+            admin1 = '%s.%s' % (country_code, fields[10])
+            admin2 = '%s.%s' % (admin1, fields[11])
+            place = json.dumps(
+                {
+                    'id': int(fields[0]),
+                    'name': fields[1],
+                    'county': counties.get(admin2, ''),
+                    'state': states.get(admin1, ''),
+                    'country': countries.get(country_code, country_code),
+                    'country_code': country_code.lower()
+                },
+                ensure_ascii=False).encode()
+            key = offline_cell_key(int((lat + 90) // offline_cell),
+                                   int((lon + 180) // offline_cell))
+            places.append((key, lat, lon, place))
+    places.sort(key=lambda place: place[0])
+
+    offsets = [0]
+    for place in places:
+        offsets.append(offsets[-1] + len(place[3]))
+    with open(path, 'wb') as f:
+        f.write(offline_index_header.pack(offline_index_magic, len(places),
+                                          offsets[-1]))
+        f.write(struct.pack('<%dq' % len(places),
+                            *[place[0] for place in places]))
+        f.write(struct.pack('<%df' % len(places),
+                            *[place[1] for place in places]))
+        f.write(struct.pack('<%df' % len(places),
+                            *[place[2] for place in places]))
+        f.write(struct.pack('<%dq' % len(offsets), *offsets))
+        for place in places:
+            f.write(place[3])
+    logging.info("%d places are saved to offline index %s." %
+                 (len(places), path))
+
+
+class OfflineIndex:
+    '''
+    memory mapped index of places, resolve coordinate to nearest place
+    without api.
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, _ = offline_index_header.unpack_from(self.mm)
+        if magic != offline_index_magic:
+            raise ValueError("%s is not an offline index." % path)
+        view = memoryview(self.mm)
+        start = offline_index_header.size
+        self.keys = view[start:start + count * 8].cast('q')
+        start += count * 8
+        self.lats = view[start:start + count * 4].cast('f')
+        start += count * 4
+        self.lons = view[start:start + count * 4].cast('f')
+        start += count * 4
+        self.offsets = view[start:start + (count + 1) * 8].cast('q')
+        self.places = start + (count + 1) * 8
+
+    def nearest(self, lat, lon):
+        '''nearest place in the cell of coordinate and cells around it.'''
+        lat = float(lat)
+        lon = float(lon)
+        row = int((lat + 90) // offline_cell)
+        col = int((lon + 180) // offline_cell)
+        best = None
+        best_dist = None
+        for i in range(row - 1, row + 2):
+            for j in range(col - 1, col + 2):
+                key = offline_cell_key(i, j)
+                for index in range(bisect_left(self.keys, key),
+                                   bisect_right(self.keys, key)):
+                    dist = distance(lat, lon, self.lats[index],
+                                    self.lons[index])
+                    if best_dist is None or dist < best_dist:
+                        best = index
+                        best_dist = dist
+        if best is None:
+            return None
+        place = json.loads(
+            self.mm[self.places + self.offsets[best]:self.places +
+                    self.offsets[best + 1]])
+        place['lat'] = self.lats[best]
+        place['lon'] = self.lons[best]
+        return place
+
+    def resolve(self, lat, lon):
+        '''resolve coordinate as open street map address dict and raw.'''
+        place = self.nearest(lat, lon)
+        if place is None:
+            return None, None
+        names = [place['name'], place['county'], place['state'],
+                 place['country']]
+        osm_address = {
+            'osm_id': place['id'],
+            'osm_type': 'geonames',
+            'lat': '%.6f' % place['lat'],
+            'lon': '%.6f' % place['lon'],
+            'name': place['name'],
+            'display_name': ', '.join(name for name in names if len(name) > 0),
+            # empty names are not in address, same as open street map.
+            'address': {
+                key: value
+                for key, value in [('city', place['name']),
+                                   ('county', place['county']),
+                                   ('state', place['state']),
+                                   ('country', place['country']),
+                                   ('country_code', place['country_code'])]
+                if len(value) > 0
+            },
+            'namedetails': {}
+        }
+        return osm_address, json.dumps(osm_address, ensure_ascii=False)
+
+
+offline_index = None
+
+
+def load_offline_index():
+    '''open offline index if set, only once.'''
+    global offline_index
+    if len(args.offline_index) > 0 and offline_index is None:
+        offline_index = OfflineIndex(args.offline_index)
+
+
+# coordinate of a position, positions are loaded with drives and chargings.
+Position = namedtuple('Position', ['latitude', 'longitude'])
+
+
+@profiled('query')
+def get_empty_drives(session, batch_size, after_id, ids=None,
+                     started_since=None, started_before=None):
+    '''
+    get drives without address, joined with start and end positions.
+    drives are ordered by id, only drives after after_id are returned.
+    if ids is set, only these drives are returned.
+    if started_since or started_before is set, only drives started in it are
+    returned.
+    '''
+    StartPositions = aliased(Positions)
+    EndPositions = aliased(Positions)
+    query = session\
+        .query(Drives.id,
+               StartPositions.latitude.label('start_latitude'),
+               StartPositions.longitude.label('start_longitude'),
+               EndPositions.latitude.label('end_latitude'),
+               EndPositions.longitude.label('end_longitude'))\
+        .join(StartPositions, Drives.start_position_id == StartPositions.id)\
+        .join(EndPositions, Drives.end_position_id == EndPositions.id)\
+        .filter(or_(Drives.start_address_id.is_(None), Drives.end_address_id.is_(None)))\
+        .filter(~failed_records('drive', Drives.id, due=False))\
+        .filter(Drives.id > after_id)
+    if ids is not None:
+        query = query.filter(Drives.id.in_(ids))
+    if started_since is not None:
+        query = query.filter(Drives.start_date >= started_since)
+    if started_before is not None:
+        query = query.filter(Drives.start_date < started_before)
+    if args.claim != 0:
+        # records locked by other fixers are skipped.
+        query = query.with_for_update(skip_locked=True, of=Drives)
+    return query.order_by(Drives.id).limit(batch_size).all()
+
+
+@profiled('query')
+def get_empty_chargings(session, batch_size, after_id, ids=None,
+                        started_since=None, started_before=None):
+    '''
+    get charging processes without address, joined with positions.
+    charging processes are ordered by id, only ones after after_id are returned.
+    if ids is set, only these charging processes are returned.
+    if started_since or started_before is set, only charging processes started
+    in it are returned.
+    '''
+    query = session\
+        .query(ChargingProcesses.id, Positions.latitude, Positions.longitude)\
+        .join(Positions, ChargingProcesses.position_id == Positions.id)\
+        .filter(ChargingProcesses.address_id.is_(None))\
+        .filter(~failed_records('charging', ChargingProcesses.id, due=False))\
+        .filter(ChargingProcesses.id > after_id)
+    if ids is not None:
+        query = query.filter(ChargingProcesses.id.in_(ids))
+    if started_since is not None:
+        query = query.filter(ChargingProcesses.start_date >= started_since)
+    if started_before is not None:
+        query = query.filter(ChargingProcesses.start_date < started_before)
+    if args.claim != 0:
+        # records locked by other fixers are skipped.
+        query = query.with_for_update(skip_locked=True, of=ChargingProcesses)
+    return query.order_by(ChargingProcesses.id).limit(batch_size).all()
+
+
+def open_cache(path):
+    '''open persistent geocode cache, return None if cache is disabled.'''
+    if len(path) == 0:
+        return None
+    import sqlite3
+    # Timer runs main in another thread in infinity mode.
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute('''CREATE TABLE IF NOT EXISTS geocode_cache (
+                        provider TEXT NOT NULL,
+                        lat INTEGER NOT NULL,
+                        lon INTEGER NOT NULL,
+                        raw TEXT NOT NULL,
+                        created_at REAL NOT NULL,
+                        used_at REAL NOT NULL,
+                        PRIMARY KEY (provider, lat, lon))''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS geocode_cache_used_at
+                    ON geocode_cache (used_at)''')
+    # drop expired responses at startup.
+    conn.execute("DELETE FROM geocode_cache WHERE created_at < ?",
+                 (time.time() - args.cache_ttl * 86400, ))
+    conn.commit()
+    return conn
+
+
+cache_conn = open_cache(args.cache)
+cache_lock = Lock()
+# rows in cache, counted once at startup and tracked by puts and deletes.
+cache_count = 0 if cache_conn is None else \
+    cache_conn.execute("SELECT count(*) FROM geocode_cache").fetchone()[0]
+
+
+def cache_key(provider, lat, lon):
+    '''quantize coordinate as cache key.'''
+    scale = 10**args.cache_precision
+    return provider, int(round(float(lat) * scale)), int(round(float(lon) * scale))
+
+
+def cache_get(provider, lat, lon):
+    '''get cached response, return None if missed or expired.'''
+    global cache_count
+    if cache_conn is None:
+        return None
+    key = cache_key(provider, lat, lon)
+    now = time.time()
+    with cache_lock:
+        row = cache_conn.execute(
+            '''SELECT raw, created_at FROM geocode_cache
+               WHERE provider = ? AND lat = ? AND lon = ?''', key).fetchone()
+        if row is None:
+            metrics.inc('cache_requests_total',
+                        {'provider': provider, 'result': 'miss'})
+            return None
+        if row[1] < now - args.cache_ttl * 86400:
+            deleted = cache_conn.execute(
+                '''DELETE FROM geocode_cache
+                   WHERE provider = ? AND lat = ? AND lon = ?''', key).rowcount
+            cache_conn.commit()
+            cache_count -= deleted
+            metrics.inc('cache_requests_total',
+                        {'provider': provider, 'result': 'expired'})
+            return None
+        # refresh LRU position.
+        cache_conn.execute(
+            '''UPDATE geocode_cache SET used_at = ?
+               WHERE provider = ? AND lat = ? AND lon = ?''', (now, ) + key)
+        cache_conn.commit()
+    metrics.inc('cache_requests_total', {'provider': provider, 'result': 'hit'})
+    return row[0]
+
+
+def cache_put(provider, lat, lon, raw):
+    '''save response to cache, evict least recently used ones if full.'''
+    global cache_count
+    if cache_conn is None:
+        return
+    now = time.time()
+    key = cache_key(provider, lat, lon)
+    with cache_lock:
+        inserted = cache_conn.execute(
+            '''INSERT OR IGNORE INTO geocode_cache
+               (provider, lat, lon, raw, created_at, used_at)
+               VALUES (?, ?, ?, ?, ?, ?)''', key + (raw, now, now)).rowcount
+        if inserted == 0:
+            # cached by another thread meanwhile.
+            cache_conn.execute(
+                '''UPDATE geocode_cache SET raw = ?, created_at = ?, used_at = ?
+                   WHERE provider = ? AND lat = ? AND lon = ?''',
+                (raw, now, now) + key)
+        cache_count += inserted
+        if cache_count > args.cache_size:
+            cache_count -= cache_conn.execute(
+                '''DELETE FROM geocode_cache WHERE rowid IN (
+                       SELECT rowid FROM geocode_cache
+                       ORDER BY used_at LIMIT ?)''',
+                (cache_count - args.cache_size, )).rowcount
+        cache_conn.commit()
+
+
+def create_http_session():
+    '''create long-lived http session, connections are kept alive and reused.'''
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    retry = Retry(total=args.retry,
+                  backoff_factor=args.backoff,
+                  status_forcelist=[500, 502, 504],
+                  allowed_methods=['GET'],
+                  # urllib3 retries 413, 429 and 503 with Retry-After itself,
+                  # return them at once, so rate limiter throttles on them.
+                  respect_retry_after_header=False,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=args.pool_size,
+                          pool_maxsize=args.pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({
         'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
         'accept-language': 'zh-CN,zh;q=0.9,en-US;q=0.8,en;q=0.7',
         'cache-control': 'max-age=0',
@@ -284,148 +1343,746 @@ def http_request(url):
         'sec-fetch-user': '?1',
         'upgrade-insecure-requests': '1',
         'User-Agent': args.user_agent
-    }
+    })
+    return session
+
 
+# shared by nominatim and amap requests, created on first request.
+http_session = None
+http_session_lock = Lock()
+
+
+def get_http_session():
+    '''get shared http session.'''
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            http_session = create_http_session()
+    return http_session
+
+
+class RateLimiter:
+    '''
+    token bucket, limit request rate to a map api provider.
+    rate is adapted by responses (AIMD), and the provider is paused after
+    too many failures in a row (circuit breaker).
+    '''
+
+    def __init__(self, rate, provider):
+        self.provider = provider
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.failures = 0
+        self.lock = Lock()
+
+    def acquire(self):
+        '''take a token, block until it is available.'''
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(1.0,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # token can be borrowed, waiters are queued by borrowing order.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def wait_time(self):
+        '''seconds to wait if a token is taken now.'''
+        with self.lock:
+            now = time.monotonic()
+            pause = max(self.paused_until - now, 0)
+            if self.rate <= 0:
+                return pause
+            tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+            return max(pause, (1 - tokens) / self.rate)
+
+    def succeeded(self):
+        '''increase rate additively up to max rate.'''
+        with self.lock:
+            self.failures = 0
+            if self.max_rate > 0:
+                self.rate = min(self.max_rate,
+                                self.rate + self.max_rate * aimd_increase)
+                metrics.set('request_rate', self.rate,
+                            {'provider': self.provider})
+
+    def throttled(self, retry_after=None):
+        '''decrease rate multiplicatively, and pause if retry_after is set.'''
+        metrics.inc('throttled_total', {'provider': self.provider})
+        with self.lock:
+            if self.max_rate > 0:
+                self.rate = max(self.max_rate * aimd_min,
+                                self.rate * aimd_decrease)
+                metrics.set('request_rate', self.rate,
+                            {'provider': self.provider})
+            elif retry_after is None:
+                # no rate to decrease, wait a while.
+                retry_after = 1
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until,
+                                        time.monotonic() + retry_after)
+        logging.warning("%s is over rate limit, max rate is %.2f/s now." %
+                        (self.provider, self.rate))
+        self.failed()
+
+    def failed(self):
+        '''pause provider if failed too many times in a row.'''
+        with self.lock:
+            self.failures += 1
+            if args.breaker_failures <= 0 or \
+                    self.failures < args.breaker_failures:
+                return
+        self.trip(args.breaker_pause)
+
+    def trip(self, pause):
+        '''pause provider, one more failure after pause trips again.'''
+        metrics.inc('circuit_open_total', {'provider': self.provider})
+        with self.lock:
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + pause)
+            self.failures = max(args.breaker_failures - 1, 0)
+        logging.warning("%s is paused for %d seconds." %
+                        (self.provider, pause))
+
+
+def get_retry_after(response):
+    '''seconds in Retry-After header, None if not set.'''
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
     try:
-        response = http_session.get(url=url, timeout=args.timeout, headers=headers)
-        if response.status_code != requests.codes.ok:
+        from email.utils import parsedate_to_datetime
+        retry_at = parsedate_to_datetime(retry_after)
+        return max(retry_at.timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+# every nominatim endpoint has its own limit, labeled by host in metrics.
+osm_limiters = [RateLimiter(args.osm_qps, 'osm:%s' % urlparse(url).netloc)
+                for url in osm_urls]
+
+
+def amap_today():
+    '''amap daily quota is reset at 00:00 in china.'''
+    return (datetime.now(timezone.utc) + timedelta(hours=8)).date()
+
+
+class AmapKeyPool:
+    '''
+    amap keys, every key has its own rate limit and daily quota.
+    usage is saved in db, so quota is tracked across restarts.
+    '''
+
+    def __init__(self, keys):
+        self.keys = [{
+            'key': key,
+            'hash': hashlib.sha256(key.encode()).hexdigest(),
+            'limiter': RateLimiter(args.amap_qps, 'amap'),
+            'day': amap_today(),
+            'used': 0,
+            # requests not saved to db yet.
+            'unsaved': 0,
+            'exhausted': False
+        } for key in keys]
+        self.lock = Lock()
+        self.warned_day = None
+
+    def usable(self, key):
+        '''whether key has quota today, usage is reset on a new day.'''
+        today = amap_today()
+        if key['day'] != today:
+            key['day'] = today
+            key['used'] = 0
+            key['unsaved'] = 0
+            key['exhausted'] = False
+        if key['exhausted']:
+            return False
+        return args.amap_daily_quota <= 0 or \
+            key['used'] < args.amap_daily_quota
+
+    def available(self):
+        '''whether any key has quota today.'''
+        with self.lock:
+            return any(self.usable(key) for key in self.keys)
+
+    def acquire(self):
+        '''
+        take the key which is available soonest (then with most quota left),
+        block until its rate limit allows. None if all keys are used up.
+        '''
+        with self.lock:
+            keys = [key for key in self.keys if self.usable(key)]
+            if len(keys) == 0:
+                if self.warned_day != amap_today():
+                    self.warned_day = amap_today()
+                    logging.error("all amap keys are used up today.")
+                return None
+            key = min(keys,
+                      key=lambda key: (key['limiter'].wait_time(), key['used']))
+            key['used'] += 1
+            key['unsaved'] += 1
+        key['limiter'].acquire()
+        return key
+
+    def exhaust(self, key):
+        '''key returns quota used up, skip it until tomorrow.'''
+        with self.lock:
+            key['exhausted'] = True
+        logging.warning("amap key ...%s is used up today." % key['key'][-4:])
+        self.save()
+
+    def load(self):
+        '''load usage of keys today from db.'''
+        if len(self.keys) == 0:
+            return
+        with engine.connect() as connection:
+            usages = {
+                usage.key_hash: usage
+                for usage in connection.execute(
+                    select(amap_key_usages).where(
+                        amap_key_usages.c.key_hash.in_(
+                            [key['hash'] for key in self.keys])))
+            }
+        with self.lock:
+            for key in self.keys:
+                usage = usages.get(key['hash'])
+                if usage is not None and usage.day == key['day']:
+                    key['used'] = max(key['used'], usage.used)
+                    key['exhausted'] = key['exhausted'] or usage.exhausted
+
+    def save(self):
+        '''
+        add unsaved usage of keys to db, other fixers may use the same keys.
+        usage of keys is synced with db.
+        '''
+        if len(self.keys) == 0:
+            return
+        with self.lock:
+            rows = [
+                dict(key_hash=key['hash'],
+                     day=key['day'],
+                     used=key['unsaved'],
+                     exhausted=key['exhausted']) for key in self.keys
+            ]
+        statement = insert(amap_key_usages).values(rows)
+        same_day = amap_key_usages.c.day == statement.excluded.day
+        with engine.begin() as connection:
+            usages = connection.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[amap_key_usages.c.key_hash],
+                    set_={
+                        'day': statement.excluded.day,
+                        'used': case(
+                            (same_day, amap_key_usages.c.used +
+                             statement.excluded.used),
+                            else_=statement.excluded.used),
+                        'exhausted': case(
+                            (same_day, amap_key_usages.c.exhausted |
+                             statement.excluded.exhausted),
+                            else_=statement.excluded.exhausted)
+                    }).returning(amap_key_usages.c.key_hash,
+                                 amap_key_usages.c.day,
+                                 amap_key_usages.c.used,
+                                 amap_key_usages.c.exhausted)).all()
+        usages = {usage.key_hash: usage for usage in usages}
+        with self.lock:
+            for key, row in zip(self.keys, rows):
+                usage = usages.get(key['hash'])
+                if usage is None or usage.day != key['day']:
+                    continue
+                # requests made while saving are saved next time.
+                key['unsaved'] -= row['used']
+                key['used'] = usage.used + key['unsaved']
+                key['exhausted'] = key['exhausted'] or usage.exhausted
+
+
+amap_keys = AmapKeyPool(
+    [key.strip() for key in args.key.split(',') if len(key.strip()) > 0])
+
+
+def resolve_concurrently(resolver, coordinates):
+    '''
+    call resolver(lat, lon) for coordinates concurrently.
+    return results in dict, key is coordinate.
+    '''
+    coordinates = list(set(coordinates))
+    if args.concurrency <= 1 or len(coordinates) <= 1:
+        return {}
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = executor.map(resolver,
+                               [coordinate[0] for coordinate in coordinates],
+                               [coordinate[1] for coordinate in coordinates])
+        return dict(zip(coordinates, results))
+
+
+# why the last request of a thread failed, saved by coordinate when resolving
+# failed, so records can be retried later by error.
+request_error = local()
+resolve_errors = {}
+resolve_errors_lock = Lock()
+
+
+def set_request_error(error):
+    '''remember why the last request of this thread failed.'''
+    request_error.value = error
+
+
+def set_resolve_error(provider, lat, lon, error=None):
+    '''
+    remember why coordinate failed to resolve, error of the last request of
+    this thread if error is None.
+    '''
+    if error is None:
+        error = getattr(request_error, 'value', None) or 'unknown'
+    with resolve_errors_lock:
+        resolve_errors[(provider, lat, lon)] = error
+
+
+def pop_resolve_errors(provider, coordinates):
+    '''return and forget errors of coordinates in dict, key is coordinate.'''
+    errors = {}
+    with resolve_errors_lock:
+        for coordinate in set(coordinates):
+            error = resolve_errors.pop((provider, ) + tuple(coordinate), None)
+            if error is not None:
+                errors[coordinate] = error
+    return errors
+
+
+@profiled('http_request')
+def http_request(url, provider, limiter=None):
+    '''
+    get response by calling map api, provider is used by metrics.
+    limiter is told of failures, successes are told by caller, after
+    response body is checked.
+    '''
+    set_request_error(None)
+    start = time.monotonic()
+    try:
+        response = get_http_session().get(url=url, timeout=args.timeout)
+        metrics.observe('http_request_seconds', time.monotonic() - start, {
+            'provider': provider,
+            'status': response.status_code
+        })
+        retries = getattr(response.raw, 'retries', None)
+        if retries is not None and len(retries.history) > 0:
+            metrics.inc('http_retries_total', {'provider': provider},
+                        len(retries.history))
+        if response.status_code != 200:
             logging.error(
                 "Http request failed by url: %s, code: %d, body: %s" %
                 (url, response.status_code, response.text))
+            set_request_error('http_%d' % response.status_code)
+            if limiter is not None and response.status_code in [429, 503]:
+                limiter.throttled(get_retry_after(response))
+            elif limiter is not None:
+                limiter.failed()
             return None
         raw = response.text
         return raw
     except:
+        metrics.observe('http_request_seconds', time.monotonic() - start, {
+            'provider': provider,
+            'status': 'error'
+        })
         logging.error("Http request exception by url: %s" % (url))
+        set_request_error('http_exception')
+        if limiter is not None:
+            limiter.failed()
         return None
 
 
-def get_address_in_db(session, osm_id):
-    '''select address from db, get address id which just added.'''
-    return session.query(Addresses).filter(Addresses.osm_id == osm_id).first()
-
-
-def add_osm_address(session, osm_address, raw):
-    '''add osm address to db.'''
-    exist_address = get_address_in_db(session, osm_address['osm_id'])
-    if exist_address is None:
-        logging.info("oms id = %d is not exist!" % osm_address['osm_id'])
-    if exist_address is None:
-        address = Addresses(
-            display_name=osm_address['display_name'],
-            latitude=osm_address['lat'],
-            longitude=osm_address['lon'],
-            name=get_address_name(osm_address),
-            house_number=get_address_str(osm_address['address'],
-                                         house_number_aliases),
-            road=get_address_str(osm_address['address'], road_aliases),
-            neighbourhood=get_address_str(osm_address['address'],
-                                          neighborhood_aliases),
-            city=get_address_str(osm_address['address'], city_aliases),
-            county=get_address_str(osm_address['address'], county_aliases),
-            postcode=get_address_str(osm_address['address'], ['postcode']),
-            state=get_address_str(osm_address['address'], state_aliases),
-            state_district=get_address_str(osm_address['address'],
-                                           ['state_district']),
-            country=get_address_str(osm_address['address'], country_aliases),
-            raw=raw,
-            inserted_at=datetime.now().replace(microsecond=0),
-            updated_at=datetime.now().replace(microsecond=0),
-            osm_id=osm_address['osm_id'],
-            osm_type=osm_address['osm_type'])
-        session.add(address)
-        logging.info("address added: %s." % osm_address['display_name'])
-    else:
+def get_osm_address_values(osm_address, raw):
+    '''get column values of osm address for table addresses.'''
+    return dict(
+        display_name=osm_address['display_name'],
+        latitude=osm_address['lat'],
+        longitude=osm_address['lon'],
+        name=get_address_name(osm_address),
+        house_number=get_address_str(osm_address['address'],
+                                     house_number_aliases),
+        road=get_address_str(osm_address['address'], road_aliases),
+        neighbourhood=get_address_str(osm_address['address'],
+                                      neighborhood_aliases),
+        city=get_address_str(osm_address['address'], city_aliases),
+        county=get_address_str(osm_address['address'], county_aliases),
+        postcode=get_address_str(osm_address['address'], ['postcode']),
+        state=get_address_str(osm_address['address'], state_aliases),
+        state_district=get_address_str(osm_address['address'],
+                                       ['state_district']),
+        country=get_address_str(osm_address['address'], country_aliases),
+        raw=raw,
+        inserted_at=datetime.now().replace(microsecond=0),
+        updated_at=datetime.now().replace(microsecond=0),
+        osm_id=osm_address['osm_id'],
+        osm_type=osm_address['osm_type'])
+
+
+@profiled('address_insert')
+def add_osm_addresses(session, address_values):
+    '''
+    add osm addresses to db by one statement, skip existing ones.
+    return address id and display_name in dict, key is (osm_id, osm_type).
+    '''
+    if len(address_values) == 0:
+        return {}
+    columns = (Addresses.id, Addresses.display_name, Addresses.latitude,
+               Addresses.longitude, Addresses.osm_id, Addresses.osm_type)
+    added_addresses = session.execute(
+        insert(Addresses)\
+        .values(address_values)\
+        .on_conflict_do_nothing()\
+        .returning(*columns)).all()
+    for address in added_addresses:
+        logging.info("address added: %s." % address.display_name)
+
+    # conflicted addresses are not returned, select them.
+    added_keys = set((address.osm_id, address.osm_type)
+                     for address in added_addresses)
+    exist_keys = [(value['osm_id'], value['osm_type'])
+                  for value in address_values
+                  if (value['osm_id'], value['osm_type']) not in added_keys]
+    exist_addresses = []
+    if len(exist_keys) > 0:
+        exist_addresses = session.execute(
+            select(*columns)\
+            .where(tuple_(Addresses.osm_id, Addresses.osm_type).in_(exist_keys))).all()
+    for address in exist_addresses:
         logging.info("address is already exist: %d, %s." %
-                     (osm_address['osm_id'], osm_address['display_name']))
+                     (address.osm_id, address.display_name))
+
+    addresses = {}
+    for address in added_addresses + exist_addresses:
+        addresses[(address.osm_id, address.osm_type)] = (address.id,
+                                                         address.display_name)
+        if address_index is not None:
+            address_index.add(address.id, address.display_name,
+                              address.latitude, address.longitude)
+    return addresses
 
 
-def get_address(session, position):
+def request_osm(lat, lon):
     '''
-    return address id and display_name by position id. 
-    Address will add into db if not exists.
+    request nominatim endpoints in order, next endpoint is requested too if
+    no response in hedge delay, or at once if failed. first response wins.
+    endpoints paused or limited longer than hedge delay are requested last.
     '''
-    url = osm_resolve_url % (position.latitude, position.longitude)
-    raw = http_request(url)
+    urls = [osm_url + osm_resolve_path % (lat, lon) for osm_url in osm_urls]
+    if len(urls) == 1:
+        osm_limiters[0].acquire()
+        raw = http_request(urls[0], osm_limiters[0].provider, osm_limiters[0])
+        if raw is not None:
+            osm_limiters[0].succeeded()
+        return raw
+
+    responses = queue.Queue()
+
+    def request(i):
+        osm_limiters[i].acquire()
+        raw = http_request(urls[i], osm_limiters[i].provider, osm_limiters[i])
+        if raw is not None:
+            osm_limiters[i].succeeded()
+        responses.put(raw)
+
+    waits = [limiter.wait_time() for limiter in osm_limiters]
+    order = sorted(range(len(urls)),
+                   key=lambda i: (waits[i] > args.hedge_delay,
+                                  waits[i] if waits[i] > args.hedge_delay else 0))
+    pending = 0
+    for n, i in enumerate(order):
+        # slower requests are not cancelled, their responses are dropped.
+        Thread(target=request, args=(i, ), daemon=True).start()
+        pending += 1
+        last = n == len(order) - 1
+        deadline = time.monotonic() + args.hedge_delay
+        while pending > 0:
+            timeout = None
+            if not last and args.hedge_delay > 0:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+            try:
+                raw = responses.get(timeout=timeout)
+            except queue.Empty:
+                break
+            pending -= 1
+            if raw is not None:
+                return raw
+            if not last:
+                break
+    set_request_error('osm_unavailable')
+    return None
+
+
+def resolve_osm_address(lat, lon):
+    '''resolve coordinate by open street map, return address dict and raw.'''
+    if offline_index is not None:
+        osm_address, raw = offline_index.resolve(lat, lon)
+        if osm_address is None:
+            set_resolve_error('osm', lat, lon, 'not_found')
+        return osm_address, raw
+    raw = cache_get('osm', lat, lon)
     if raw is None:
-        return None, None
+        raw = request_osm(lat, lon)
+        if raw is None:
+            set_resolve_error('osm', lat, lon)
+            return None, None
+        cached = False
+    else:
+        cached = True
 
-    osm_address = json.loads(raw)
+    with profile_stage('json_parse'):
+        osm_address = json.loads(raw)
     if osm_address == None:
+        set_resolve_error('osm', lat, lon, 'empty_response')
+        return None, None
+    # nominatim responses error if nothing found, such as in the sea.
+    if 'osm_id' not in osm_address:
+        logging.error("resolve address error: %s" % raw)
+        set_resolve_error('osm', lat, lon, 'not_found')
         return None, None
+    if not cached:
+        cache_put('osm', lat, lon, raw)
+    return osm_address, raw
+
+
+def get_addresses(session, positions, resolved=None):
+    '''
+    return address id and display_name of positions in dict, key is
+    coordinate. Addresses will add into db if not exists. positions failed to
+    resolve are not in dict.
+    resolved contains responses which are requested concurrently.
+    '''
+    addresses = {}
+    # new addresses by (osm_id, osm_type).
+    osm_keys = {}
+    address_values = {}
+    for position in positions:
+        coordinate = (position.latitude, position.longitude)
+        if coordinate in addresses or coordinate in osm_keys:
+            continue
 
-    add_osm_address(session, osm_address, raw)
-    added_address = get_address_in_db(session, osm_address['osm_id'])
-    return added_address.id, added_address.display_name
+        if address_index is not None:
+            nearby = address_index.nearest(*coordinate)
+            if nearby is not None:
+                addresses[coordinate] = nearby
+                continue
+
+        if resolved is not None and coordinate in resolved:
+            osm_address, raw = resolved[coordinate]
+        else:
+            osm_address, raw = resolve_osm_address(*coordinate)
+        if osm_address is None:
+            continue
+        osm_key = (osm_address['osm_id'], osm_address['osm_type'])
+        osm_keys[coordinate] = osm_key
+        address_values[osm_key] = get_osm_address_values(osm_address, raw)
 
+    added_addresses = add_osm_addresses(session,
+                                        list(address_values.values()))
+    for coordinate, osm_key in osm_keys.items():
+        if osm_key in added_addresses:
+            addresses[coordinate] = added_addresses[osm_key]
+    return addresses
 
-def fix_address(session, batch_size, empty_count):
-    processed_count = 0
-    # get empty records in drives.
-    empty_drive_addresses = session\
-        .query(Drives)\
-        .filter(or_(Drives.start_address_id.is_(None), Drives.end_address_id.is_(None)))\
-        .filter(Drives.start_position_id.is_not(None))\
-        .filter(Drives.end_position_id.is_not(None))\
-        .limit(batch_size)\
-        .all()
+
+def link_addresses(session, table, address_columns, links):
+    '''
+    set address ids of records by one statement.
+    links are tuples of record id and address ids of address_columns.
+    '''
+    if len(links) == 0:
+        return
+    link_values = values(column('id', Integer),
+                         *[column(address_column.key, Integer)
+                           for address_column in address_columns],
+                         name='links').data(links)
+    session.execute(
+        update(table)\
+        .where(table.id == link_values.c.id)\
+        .values({address_column.key: link_values.c[address_column.key]
+                 for address_column in address_columns})\
+        .execution_options(synchronize_session=False))
+
+
+def resolve_osm_unknown(lat, lon):
+    '''resolve coordinate by open street map if no nearby known address.'''
+    if address_index is not None and \
+            address_index.nearest(lat, lon) is not None:
+        return None, None
+    return resolve_osm_address(lat, lon)
+
+
+def new_empty_cursor():
+    '''
+    cursor of empty records, fresh records of FRESH_WINDOW are fetched by
+    their own cursor.
+    '''
+    return {'drive': 0, 'charging': 0, 'fresh_drive': 0, 'fresh_charging': 0}
+
+
+def get_empty_records(session, batch_size, cursor, ids=None):
+    '''
+    get a batch of empty drives and charging processes after cursor, cursor is
+    moved past all fetched records. with FRESH_WINDOW, records started in it
+    are fetched first, up to FRESH_SHARE of batch, older ones fill the rest.
+    return drives and charging processes.
+    '''
+    fresh_drives = []
+    fresh_chargings = []
+    fresh_since = None
+    fresh_size = min(math.ceil(batch_size * args.fresh_share), batch_size)
+    if args.fresh_window > 0 and fresh_size > 0:
+        # teslamate saves start_date in utc.
+        fresh_since = datetime.now(timezone.utc).replace(tzinfo=None) - \
+            timedelta(seconds=args.fresh_window)
+        fresh_drives = get_empty_drives(
+            session, fresh_size, cursor['fresh_drive'],
+            None if ids is None else ids['drive'], started_since=fresh_since)
+        if len(fresh_drives) < fresh_size:
+            fresh_chargings = get_empty_chargings(
+                session, fresh_size - len(fresh_drives),
+                cursor['fresh_charging'],
+                None if ids is None else ids['charging'],
+                started_since=fresh_since)
+        if len(fresh_drives) > 0:
+            cursor['fresh_drive'] = fresh_drives[-1].id
+        if len(fresh_chargings) > 0:
+            cursor['fresh_charging'] = fresh_chargings[-1].id
+        if len(fresh_drives) + len(fresh_chargings) > 0:
+            logging.info("%d fresh drives and %d fresh chargings first." %
+                         (len(fresh_drives), len(fresh_chargings)))
+    batch_size -= len(fresh_drives) + len(fresh_chargings)
+
+    # get empty records in drives, positions are loaded in the same query.
+    drives = get_empty_drives(session, batch_size, cursor['drive'],
+                              None if ids is None else ids['drive'],
+                              started_before=fresh_since)
 
     # get empty records in charging_processes, all records are LE batch_size.
-    empty_charging_addresses = []
-    if len(empty_drive_addresses) < batch_size:
-        empty_charging_addresses = session\
-            .query(ChargingProcesses)\
-            .filter(ChargingProcesses.address_id.is_(None))\
-            .filter(ChargingProcesses.position_id.is_not(None))\
-            .limit(batch_size - len(empty_drive_addresses))\
-            .all()
-
-    # processing drives.
-    for empty_drive_address in empty_drive_addresses:
-        logging.info("processing drive address (%d left)" % (empty_count - processed_count))
-
-        # get positions.
-        start_position_id = empty_drive_address.start_position_id
-        end_position_id = empty_drive_address.end_position_id
-        start_position = get_position(session, start_position_id)
-        end_position = get_position(session, end_position_id)
-
-        # get addresses.
-        start_address_id, start_address = get_address(session, start_position)
-        end_address_id, end_address = get_address(session, end_position)
-        if start_address_id is None or end_address_id is None:
+    chargings = []
+    if len(drives) < batch_size:
+        chargings = get_empty_chargings(
+            session, batch_size - len(drives), cursor['charging'],
+            None if ids is None else ids['charging'],
+            started_before=fresh_since)
+
+    if len(drives) > 0:
+        cursor['drive'] = drives[-1].id
+    if len(chargings) > 0:
+        cursor['charging'] = chargings[-1].id
+    return fresh_drives + drives, fresh_chargings + chargings
+
+
+def get_record_coordinates(drives, chargings):
+    '''
+    return empty records as tuples of kind, row and coordinates, drives have
+    start and end coordinates.
+    '''
+    records = []
+    for drive in drives:
+        records.append(('drive', drive, [
+            (drive.start_latitude, drive.start_longitude),
+            (drive.end_latitude, drive.end_longitude)
+        ]))
+    for charging in chargings:
+        records.append(('charging', charging,
+                        [(charging.latitude, charging.longitude)]))
+    return records
+
+
+def link_records(session, records, addresses, errors, empty_count):
+    '''
+    link addresses to records of get_record_coordinates, addresses are from
+    get_addresses and errors are resolve errors, both keyed by coordinate.
+    records failed are saved to retry later. return processed records count.
+    '''
+    processed_count = 0
+    links = {'drive': [], 'charging': []}
+    record_errors = {'drive': {}, 'charging': {}}
+    for kind, row, coordinates in records:
+        logging.info("processing %s address (%d left)" %
+                     (kind, empty_count - processed_count))
+        record_addresses = [addresses.get(coordinate)
+                            for coordinate in coordinates]
+        if None in record_addresses:
+            record_errors[kind][row.id] = next(
+                (errors[coordinate] for coordinate in coordinates
+                 if coordinate in errors), 'unknown')
             continue
 
         # update address ids.
-        empty_drive_address.start_address_id = start_address_id
-        empty_drive_address.end_address_id = end_address_id
-        logging.info("Changing drives(id = %d) start address to %s" %
-                     (empty_drive_address.id, start_address))
-        logging.info("Changing drives(id = %d) end address to %s" %
-                     (empty_drive_address.id, end_address))
+        links[kind].append(
+            tuple([row.id] + [address[0] for address in record_addresses]))
+        if kind == 'drive':
+            logging.info("Changing drives(id = %d) start address to %s" %
+                         (row.id, record_addresses[0][1]))
+            logging.info("Changing drives(id = %d) end address to %s" %
+                         (row.id, record_addresses[1][1]))
+        else:
+            logging.info("Changing charging(id = %d) to %s" %
+                         (row.id, record_addresses[0][1]))
+        metrics.inc('records_total', {'mode': 'fix', 'kind': kind})
         processed_count += 1
 
-    # processing charging.
-    for empty_charging_address in empty_charging_addresses:
-        logging.info("processing charging address (%d left)" % (empty_count - processed_count))
+    # update links by one statement for each table.
+    link_addresses(session, Drives,
+                   [Drives.start_address_id, Drives.end_address_id],
+                   links['drive'])
+    link_addresses(session, ChargingProcesses, [ChargingProcesses.address_id],
+                   links['charging'])
+
+    # failed records are not fetched again until due to retry.
+    for kind in ['drive', 'charging']:
+        save_failures(session, kind, record_errors[kind])
+        clear_failures(session, kind, [link[0] for link in links[kind]])
+    return processed_count
 
-        # get position.
-        position_id = empty_charging_address.position_id
-        position = get_position(session, position_id)
 
-        # get address.
-        address_id, address = get_address(session, position)
-        if address_id is None:
-            continue
-
-        # update address id.
-        empty_charging_address.address_id = address_id
-        logging.info("Changing charging(id = %d) to %s" %
-                     (empty_charging_address.id, address))
-        processed_count += 1
+def fix_address(session, batch_size, empty_count, cursor, ids=None):
+    '''
+    fix a batch of empty records after cursor, cursor is moved past all
+    fetched records, include failed ones.
+    if ids is set, only records in ids['drive'] and ids['charging'] are fixed.
+    return fetched and processed records count.
+    '''
+    empty_drive_addresses, empty_charging_addresses = get_empty_records(
+        session, batch_size, cursor, ids)
+    records = get_record_coordinates(empty_drive_addresses,
+                                     empty_charging_addresses)
+    coordinates = [coordinate for _, _, record_coordinates in records
+                   for coordinate in record_coordinates]
+
+    # request map api concurrently if concurrency is set.
+    resolved = resolve_concurrently(resolve_osm_unknown, coordinates)
+
+    # get addresses, new addresses are added in one statement.
+    addresses = get_addresses(
+        session, [Position(*coordinate) for coordinate in coordinates],
+        resolved)
+    errors = pop_resolve_errors('osm', coordinates)
+    processed_count = link_records(session, records, addresses, errors,
+                                   empty_count)
 
     # records processed.
-    return processed_count
+    return len(records), processed_count
 
 
 def get_empty_record_count(session):
@@ -435,29 +2092,222 @@ def get_empty_record_count(session):
         .filter(or_(Drives.start_address_id.is_(None), Drives.end_address_id.is_(None)))\
         .filter(Drives.start_position_id.is_not(None))\
         .filter(Drives.end_position_id.is_not(None))\
+        .filter(~failed_records('drive', Drives.id, due=False))\
         .count()
 
     empty_count += session\
         .query(ChargingProcesses.id)\
         .filter(ChargingProcesses.address_id.is_(None))\
         .filter(ChargingProcesses.position_id.is_not(None))\
+        .filter(~failed_records('charging', ChargingProcesses.id, due=False))\
         .count()
     return empty_count
 
 
-def fix_empty_records():
+def fix_empty_records(ids=None):
+    '''
+    fix all empty records, if ids is set, only records in ids['drive'] and
+    ids['charging'] are fixed.
+    '''
+    with Session(engine) as session:
+        load_address_index(session)
+        logging.info("checking empty records...")
+        if ids is None:
+            empty_count = get_empty_record_count(session)
+        else:
+            empty_count = len(ids['drive']) + len(ids['charging'])
+    metrics.set('backlog', empty_count, {'mode': 'fix'})
+
+    # keyset pagination by id, records failed to fix are skipped.
+    cursor = new_empty_cursor()
     # for low memory devices.
     while True:
         with Session(engine) as session:
-            logging.info("checking empty records...")
-            empty_count = get_empty_record_count(session)
-            if fix_address(session, args.batch, empty_count) == 0:
+            fetched_count, processed_count = fix_address(
+                session, args.batch, empty_count, cursor, ids)
+            if fetched_count == 0:
                 # all recoreds are fixed.
                 break
             else:
                 # commit at end of each batch.
                 logging.info("saving...")
                 session.commit()
+                empty_count -= processed_count
+                metrics.set('backlog', empty_count, {'mode': 'fix'})
+
+
+def get_address_references():
+    '''tables and columns which reference addresses and positions.'''
+    return [(Drives, Drives.start_address_id, Drives.start_position_id),
+            (Drives, Drives.end_address_id, Drives.end_position_id),
+            (ChargingProcesses, ChargingProcesses.address_id,
+             ChargingProcesses.position_id)]
+
+
+def get_empty_positions(precision):
+    '''
+    get positions of all empty address references, by drives start, drives
+    end and charging processes. rounded coordinates are group keys.
+    '''
+    references = get_address_references()
+    return union_all(*[
+        select(func.round(Positions.latitude, precision).label('lat'),
+               func.round(Positions.longitude, precision).label('lon'),
+               Positions.latitude, Positions.longitude)\
+        .select_from(table)\
+        .join(Positions, position_column == Positions.id)\
+        .where(address_column.is_(None))
+        for table, address_column, position_column in references
+    ]).subquery()
+
+
+def get_empty_position_groups(connection, batch_size):
+    '''
+    yield batches of groups of empty positions ordered by rounded coordinate.
+    groups are computed once by one query, and fetched by a server side
+    cursor of connection, groups failed to resolve are skipped.
+    '''
+    positions = get_empty_positions(args.group_precision)
+    query = select(positions.c.lat, positions.c.lon,
+                   func.avg(positions.c.latitude).label('latitude'),
+                   func.avg(positions.c.longitude).label('longitude'),
+                   func.count().label('count'))\
+        .group_by(positions.c.lat, positions.c.lon)\
+        .order_by(positions.c.lat, positions.c.lon)
+    with profile_stage('query'):
+        partitions = connection\
+            .execution_options(yield_per=batch_size)\
+            .execute(query)\
+            .partitions()
+    while True:
+        with profile_stage('query'):
+            groups = next(partitions, None)
+        if groups is None:
+            return
+        yield groups
+
+
+def claim_groups(session, groups):
+    '''
+    lock groups until commit, return groups not locked by other fixers.
+    rows of groups are aggregated, so groups are locked by advisory locks.
+    '''
+    if len(groups) == 0:
+        return groups
+    keys = {}
+    for group in groups:
+        digest = hashlib.md5(
+            ('%s:%s,%s' % (notify_channel, group.lat, group.lon)).encode())
+        keys[(group.lat, group.lon)] = int.from_bytes(digest.digest()[:8],
+                                                      'big',
+                                                      signed=True)
+    claims = values(column('key', BigInteger),
+                    name='claims').data([(key, ) for key in keys.values()])
+    claimed = set(
+        session.execute(
+            select(claims.c.key).where(
+                func.pg_try_advisory_xact_lock(claims.c.key))).scalars())
+    groups = [group for group in groups
+              if keys[(group.lat, group.lon)] in claimed]
+    if len(groups) == 0:
+        return groups
+    # groups may be fixed by other fixers before locked.
+    positions = get_empty_positions(args.group_precision)
+    empty_groups = set(
+        session.execute(
+            select(positions.c.lat, positions.c.lon).where(
+                tuple_(positions.c.lat, positions.c.lon).in_(
+                    [(group.lat, group.lon) for group in groups])).distinct()).all())
+    return [group for group in groups
+            if (group.lat, group.lon) in empty_groups]
+
+
+def link_group_addresses(session, group_links):
+    '''
+    set address ids to all empty records in groups, by one statement for
+    each address column. group links are tuples of rounded lat, lon and
+    address id. return records count.
+    '''
+    link_values = values(column('lat', Numeric),
+                         column('lon', Numeric),
+                         column('address_id', Integer),
+                         name='links').data(group_links)
+    in_group = and_(
+        func.round(Positions.latitude, args.group_precision) == link_values.c.lat,
+        func.round(Positions.longitude, args.group_precision) == link_values.c.lon)
+    references = get_address_references()
+    linked_count = 0
+    for table, address_column, position_column in references:
+        result = session.execute(
+            update(table)\
+            .where(position_column == Positions.id)\
+            .where(address_column.is_(None))\
+            .where(in_group)\
+            .values({address_column.key: link_values.c.address_id})\
+            .execution_options(synchronize_session=False))
+        linked_count += result.rowcount
+    return linked_count
+
+
+def fix_group_batch(session, groups, empty_count):
+    '''fix a batch of position groups, return linked records count.'''
+    if args.claim != 0:
+        groups = claim_groups(session, groups)
+
+    # request map api concurrently if concurrency is set.
+    resolved = resolve_concurrently(
+        resolve_osm_unknown,
+        [(group.latitude, group.longitude) for group in groups])
+
+    # get addresses, new addresses are added in one statement.
+    addresses = get_addresses(
+        session,
+        [Position(group.latitude, group.longitude) for group in groups],
+        resolved)
+    # groups are not retried by failures, failed ones are checked again in
+    # next run.
+    pop_resolve_errors('osm', [(group.latitude, group.longitude)
+                               for group in groups])
+
+    group_links = []
+    for group in groups:
+        logging.info("processing %d records at (%s, %s) (%d left)" %
+                     (group.count, group.lat, group.lon, empty_count))
+        address = addresses.get((group.latitude, group.longitude))
+        if address is None:
+            continue
+        group_links.append((group.lat, group.lon, address[0]))
+        logging.info("Changing %d records at (%s, %s) to %s" %
+                     (group.count, group.lat, group.lon, address[1]))
+
+    # update links by one statement for each address column.
+    if len(group_links) == 0:
+        return 0
+    linked_count = link_group_addresses(session, group_links)
+    metrics.inc('records_total', {'mode': 'fix', 'kind': 'group'},
+                linked_count)
+    return linked_count
+
+
+def fix_grouped_records():
+    '''fix empty records by groups of nearby positions.'''
+    with Session(engine) as session:
+        load_address_index(session)
+        empty_count = session.execute(
+            select(func.count()).select_from(
+                get_empty_positions(args.group_precision))).scalar()
+    metrics.set('backlog', empty_count, {'mode': 'fix'})
+
+    # groups are computed once, and fetched by batch for low memory devices.
+    logging.info("checking empty position groups...")
+    with engine.connect() as group_connection:
+        for groups in get_empty_position_groups(group_connection, args.batch):
+            with Session(engine) as session:
+                empty_count -= fix_group_batch(session, groups, empty_count)
+                # commit at end of each batch.
+                logging.info("saving...")
+                session.commit()
+            metrics.set('backlog', empty_count, {'mode': 'fix'})
 
 
 def get_field(find, keys):
@@ -484,8 +2334,8 @@ def get_field(find, keys):
     return item
 
 
-def update_address_in_db(need_update_address, address_details):
-    # parse response.
+def get_amap_address_values(address_details):
+    '''get column values of amap address details for table addresses.'''
     country = get_field(address_details,
                         ['regeocode', 'addressComponent', 'country'])
     province = get_field(address_details,
@@ -516,135 +2366,954 @@ def update_address_in_db(need_update_address, address_details):
     if len(name) == 0:
         name = get_field(address_details, ['regeocode', 'roads', 0, 'name'])
 
-    # update db record.
-    logging.info("update address from %s to %s" %
-                 (need_update_address.display_name, display_name))
-    need_update_address.state = province
-    need_update_address.county = township
-    need_update_address.city = city
-    need_update_address.house_number = street_number
-    need_update_address.display_name = display_name
-    need_update_address.country = country
-    need_update_address.updated_at = datetime.now().replace(microsecond=0)
-
-    # record last processed record id, skip records which id less than this.
-    # assume that address record will not updated.
-    # if language changed, teslamate will update all addressed, remember to
-    # restart me to re-process all records.
-    global last_update_id
-    last_update_id = need_update_address.id
-
+    address_values = dict(state=province,
+                          county=township,
+                          city=city,
+                          house_number=street_number,
+                          display_name=display_name,
+                          country=country)
     # if some address is empty, do not update them.
     if len(road) > 0:
-        need_update_address.road = road
-
+        address_values['road'] = road
     if len(name) > 0:
-        need_update_address.name = name
-
+        address_values['name'] = name
     if len(neighborhood) > 0:
-        need_update_address.neighbourhood = neighborhood
+        address_values['neighbourhood'] = neighborhood
+    return address_values
+
+
+def get_fingerprint(address_values):
+    '''fingerprint of address values, same values have same fingerprint.'''
+    return hashlib.sha256(
+        json.dumps(address_values,
+                   sort_keys=True,
+                   ensure_ascii=False,
+                   default=str).encode()).hexdigest()
+
+
+def save_fingerprints(session, fingerprints):
+    '''
+    save fingerprints by one statement, committed with the batch.
+    fingerprints are tuples of address id, fingerprint and updated_at.
+    '''
+    if len(fingerprints) == 0:
+        return
+    statement = insert(amap_fingerprints).values([
+        dict(address_id=address_id,
+             fingerprint=fingerprint,
+             updated_at=updated_at)
+        for address_id, fingerprint, updated_at in fingerprints
+    ])
+    session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[amap_fingerprints.c.address_id],
+            set_={
+                'fingerprint': statement.excluded.fingerprint,
+                'updated_at': statement.excluded.updated_at
+            }))
 
 
-def request_amap_api(url):
+def update_address_in_db(need_update_address, address_details):
+    '''
+    update address by amap address details, the address is not written if
+    its columns already have the same values.
+    return fingerprint of amap address and whether the address is written.
+    '''
+    address_values = get_amap_address_values(address_details)
+    fingerprint = get_fingerprint(address_values)
+    current_values = {key: getattr(need_update_address, key)
+                      for key in address_values}
+    if get_fingerprint(current_values) == fingerprint:
+        logging.info("address(id = %d) is not changed: %s" %
+                     (need_update_address.id, need_update_address.display_name))
+        return fingerprint, False
+
+    # update db record.
+    logging.info("update address from %s to %s" %
+                 (need_update_address.display_name,
+                  address_values['display_name']))
+    for key, value in address_values.items():
+        setattr(need_update_address, key, value)
+    need_update_address.updated_at = datetime.now().replace(microsecond=0)
+    return fingerprint, True
+
+
+def request_amap_api(url, provider, lat, lon):
     '''request from amap api and loads as dict'''
-    response = http_request(url)
+    response = cache_get(provider, lat, lon)
+    if response is not None:
+        return json.loads(response)
+
+    response_dict = request_amap(url)
+    if response_dict is not None:
+        cache_put(provider, lat, lon, json.dumps(response_dict,
+                                                 ensure_ascii=False))
+    return response_dict
+
+
+def request_amap(url):
+    '''request from amap api without cache.'''
+    set_request_error(None)
+    # amap limits access frequency
+    key = amap_keys.acquire()
+    if key is None:
+        set_request_error('amap_no_key')
+        return None
+    response = http_request('%s&key=%s' % (url, key['key']), 'amap',
+                            key['limiter'])
     if response is None:
         return None
-    else:
-       # amap limits access frequency
-       time.sleep(0.3)
 
-    response_dict = json.loads(response)
+    with profile_stage('json_parse'):
+        response_dict = json.loads(response)
     if response_dict is None or response_dict['status'] != '1':
         logging.error("request amap api error: %s" % response)
+        # amap responds errors with status 200.
+        infocode = None if response_dict is None else \
+            response_dict.get('infocode')
+        set_request_error('amap_%s' % infocode)
+        if infocode in amap_rate_infocodes:
+            key['limiter'].throttled()
+        elif infocode in amap_quota_infocodes:
+            amap_keys.exhaust(key)
+        else:
+            key['limiter'].failed()
         return None
+    key['limiter'].succeeded()
     return response_dict
 
 
-def get_update_record_count(session):
-    # record last updated id to save cpu time.
-    return session\
-        .query(Addresses)\
-        .filter(Addresses.updated_at >= args.since)\
-        .filter(Addresses.id > last_update_id)\
-        .count()
+def load_checkpoint(session, name):
+    '''
+    load progress by name, nothing is processed if not exists.
+    started_at is the db time in utc (as teslamate saves updated_at) when
+    loaded, it is saved as watermark, so addresses changed during this run
+    are processed in next run.
+    '''
+    started_at = session.execute(
+        select(func.timezone('utc', func.now()))).scalar()
+    checkpoint = session.execute(
+        select(checkpoints.c.last_id, checkpoints.c.watermark)\
+        .where(checkpoints.c.name == name)).first()
+    if checkpoint is None:
+        return {'last_id': 0, 'watermark': datetime.min,
+                'started_at': started_at}
+    return {'last_id': checkpoint.last_id, 'watermark': checkpoint.watermark,
+            'started_at': started_at}
+
+
+def save_checkpoint(session, name, last_id, watermark):
+    '''save progress by name, committed with the batch.'''
+    session.execute(
+        insert(checkpoints)\
+        .values(name=name, last_id=last_id, watermark=watermark)\
+        .on_conflict_do_update(index_elements=[checkpoints.c.name],
+                               set_={'last_id': last_id,
+                                     'watermark': watermark}))
+
+
+def reset_checkpoint(session, name):
+    '''forget progress by name.'''
+    session.execute(delete(checkpoints).where(checkpoints.c.name == name))
+
+
+def failed_records(kind, id_column, due):
+    '''
+    condition of records failed before, which are due to retry or not.
+    kind is 'drive', 'charging' or 'address'.
+    '''
+    now = datetime.now()
+    query = select(failures.c.record_id)\
+        .where(failures.c.kind == kind)\
+        .where(failures.c.record_id == id_column)
+    if due:
+        query = query.where(failures.c.next_attempt_at <= now)
+    else:
+        query = query.where(failures.c.next_attempt_at > now)
+    return query.exists()
 
 
-def get_need_update_addresses(session, batch_size):
-    # record last update id to save cpu time.
-    return session\
-        .query(Addresses)\
+def is_permanent_error(error):
+    '''
+    whether coordinate fails again if retried soon, such as in the sea.
+    network errors, rate limits and used up keys are not.
+    '''
+    if error in ['not_found', 'empty_response']:
+        return True
+    if error.startswith('http_4'):
+        return error != 'http_429'
+    if error.startswith('amap_'):
+        return error[len('amap_'):] in amap_invalid_infocodes
+    return False
+
+
+def save_failures(session, kind, errors):
+    '''
+    save failed records, errors is dict of record id and error. records of
+    permanent errors are retried after backoff, which is doubled after every
+    failure. return ids of other records, they can be retried at once.
+    '''
+    retry_ids = [record_id for record_id, error in errors.items()
+                 if not is_permanent_error(error)]
+    errors = {record_id: error for record_id, error in errors.items()
+              if is_permanent_error(error)}
+    if len(errors) == 0 or args.retry_backoff <= 0:
+        return retry_ids
+    attempts = dict(session.execute(
+        select(failures.c.record_id, failures.c.attempts)\
+        .where(failures.c.kind == kind)\
+        .where(failures.c.record_id.in_(list(errors.keys())))).all())
+    now = datetime.now().replace(microsecond=0)
+    rows = []
+    for record_id, error in errors.items():
+        attempt = attempts.get(record_id, 0) + 1
+        backoff = min(args.retry_backoff * 2 ** min(attempt - 1, 32),
+                      retry_backoff_max)
+        rows.append({
+            'kind': kind,
+            'record_id': record_id,
+            'error': error[:64],
+            'attempts': attempt,
+            'next_attempt_at': now + timedelta(seconds=backoff)
+        })
+        logging.warning("%s(id = %d) failed %d times by %s, retry after %s." %
+                        (kind, record_id, attempt, error,
+                         now + timedelta(seconds=backoff)))
+    statement = insert(failures).values(rows)
+    session.execute(statement.on_conflict_do_update(
+        index_elements=[failures.c.kind, failures.c.record_id],
+        set_={'error': statement.excluded.error,
+              'attempts': statement.excluded.attempts,
+              'next_attempt_at': statement.excluded.next_attempt_at}))
+    metrics.inc('failures_total', {'kind': kind}, len(rows))
+    return retry_ids
+
+
+def clear_failures(session, kind, record_ids):
+    '''forget failures of records which are resolved.'''
+    if len(record_ids) == 0:
+        return
+    session.execute(
+        delete(failures)\
+        .where(failures.c.kind == kind)\
+        .where(failures.c.record_id.in_(list(record_ids))))
+
+
+def filter_need_update(query, checkpoint):
+    '''
+    addresses updated since SINCE, and not processed by checkpoint. failed
+    addresses are skipped until due to retry, even if processed.
+    '''
+    resolved = select(amap_fingerprints.c.address_id)\
+        .where(amap_fingerprints.c.address_id == Addresses.id)\
+        .where(amap_fingerprints.c.updated_at == Addresses.updated_at)
+    return query\
         .filter(Addresses.updated_at >= args.since)\
-        .filter(Addresses.id > last_update_id)\
-        .order_by(Addresses.id)\
-        .limit(batch_size)\
-        .all()
+        .filter(or_(Addresses.id > checkpoint['last_id'],
+                    Addresses.updated_at > checkpoint['watermark'],
+                    failed_records('address', Addresses.id, due=True)))\
+        .filter(~failed_records('address', Addresses.id, due=False))\
+        .filter(~resolved.exists())
+
+
+def get_update_record_count(session, checkpoint):
+    return filter_need_update(session.query(Addresses.id), checkpoint).count()
+
+
+@profiled('query')
+def get_need_update_addresses(session, batch_size, checkpoint, after_id):
+    # keyset pagination by id, records failed to update are skipped.
+    query = filter_need_update(session.query(Addresses), checkpoint)\
+        .filter(Addresses.id > after_id)
+    if args.claim != 0:
+        # records locked by other fixers are skipped.
+        query = query.with_for_update(skip_locked=True)
+    return query.order_by(Addresses.id).limit(batch_size).all()
+
+
+def convert_amap_coordinate(gps_lat, gps_lon):
+    '''convert gps coordinate to amap coordinate, None if failed.'''
+    if args.coord_convert == 'local':
+        return wgs84_to_gcj02(gps_lat, gps_lon)
+
+    # transform coordinate
+    url = amap_coordinate_transformation_url % (gps_lon, gps_lat)
+    transformed_coordinate = request_amap_api(url, 'amap_convert', gps_lat,
+                                              gps_lon)
+    if transformed_coordinate is None:
+        return None
 
+    locations = transformed_coordinate['locations']
+    amap_lon = round(float(locations.split(',')[0]), 6)
+    amap_lat = round(float(locations.split(',')[1]), 6)
+    if args.coord_convert == 'validate':
+        validate_converted((gps_lat, gps_lon), wgs84_to_gcj02(gps_lat, gps_lon),
+                           (amap_lat, amap_lon))
+    return amap_lat, amap_lon
 
-def update_address(session, batch_size, need_update_count):
-    '''update address str by amap api.'''
-    processed_count = 0
+
+def resolve_amap_address(gps_lat, gps_lon):
+    '''resolve gps coordinate by amap, return address details.'''
+    amap_coordinate = convert_amap_coordinate(gps_lat, gps_lon)
+    if amap_coordinate is None:
+        set_resolve_error('amap', gps_lat, gps_lon)
+        return None
+    amap_lat, amap_lon = amap_coordinate
+
+    # get address details
+    url = amap_resolve_url % (amap_lon, amap_lat)
+    address_details = request_amap_api(url, 'amap_regeo', amap_lat, amap_lon)
+    if address_details is None:
+        set_resolve_error('amap', gps_lat, gps_lon)
+    return address_details
+
+
+def gcj02_offset(lat, lon, m):
+    '''
+    get gcj-02 offset of wgs-84 coordinate.
+    m is math or numpy, so coordinates can be scalars or arrays.
+    '''
+    x = lon - 105.0
+    y = lat - 35.0
+    pi = m.pi
+    dlat = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + \
+        0.2 * m.sqrt(abs(x))
+    dlat += (20.0 * m.sin(6.0 * x * pi) + 20.0 * m.sin(2.0 * x * pi)) * 2.0 / 3.0
+    dlat += (20.0 * m.sin(y * pi) + 40.0 * m.sin(y / 3.0 * pi)) * 2.0 / 3.0
+    dlat += (160.0 * m.sin(y / 12.0 * pi) + 320 * m.sin(y * pi / 30.0)) * 2.0 / 3.0
+    dlon = 300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y + \
+        0.1 * m.sqrt(abs(x))
+    dlon += (20.0 * m.sin(6.0 * x * pi) + 20.0 * m.sin(2.0 * x * pi)) * 2.0 / 3.0
+    dlon += (20.0 * m.sin(x * pi) + 40.0 * m.sin(x / 3.0 * pi)) * 2.0 / 3.0
+    dlon += (150.0 * m.sin(x / 12.0 * pi) + 300.0 * m.sin(x / 30.0 * pi)) * 2.0 / 3.0
+
+    radlat = lat / 180.0 * pi
+    magic = m.sin(radlat)
+    magic = 1 - gcj02_ee * magic * magic
+    sqrtmagic = m.sqrt(magic)
+    dlat = (dlat * 180.0) / ((gcj02_a * (1 - gcj02_ee)) /
+                             (magic * sqrtmagic) * pi)
+    dlon = (dlon * 180.0) / (gcj02_a / sqrtmagic * m.cos(radlat) * pi)
+    return dlat, dlon
+
+
+def out_of_china(lat, lon):
+    '''gcj-02 is only used in china.'''
+    return lon < 72.004 or lon > 137.8347 or lat < 0.8293 or lat > 55.8271
+
+
+def wgs84_to_gcj02(lat, lon):
+    '''convert gps coordinate to amap coordinate.'''
+    lat = float(lat)
+    lon = float(lon)
+    if out_of_china(lat, lon):
+        return round(lat, 6), round(lon, 6)
+    dlat, dlon = gcj02_offset(lat, lon, math)
+    return round(lat + dlat, 6), round(lon + dlon, 6)
+
+
+def wgs84_to_gcj02_batch(coordinates):
+    '''convert gps coordinates to amap coordinates, vectorized by numpy.'''
+    try:
+        import numpy
+    except ImportError:
+        return [wgs84_to_gcj02(lat, lon) for lat, lon in coordinates]
+
+    if len(coordinates) == 0:
+        return []
+    lats = numpy.array([float(lat) for lat, _ in coordinates])
+    lons = numpy.array([float(lon) for _, lon in coordinates])
+    dlat, dlon = gcj02_offset(lats, lons, numpy)
+    in_china = (lons >= 72.004) & (lons <= 137.8347) & \
+        (lats >= 0.8293) & (lats <= 55.8271)
+    amap_lats = numpy.round(numpy.where(in_china, lats + dlat, lats), 6)
+    amap_lons = numpy.round(numpy.where(in_china, lons + dlon, lons), 6)
+    return list(zip(amap_lats.tolist(), amap_lons.tolist()))
+
+
+def validate_converted(gps_coordinate, local_coordinate, remote_coordinate):
+    '''log if local converted coordinate is different from amap api.'''
+    dist = distance(local_coordinate[0], local_coordinate[1],
+                    remote_coordinate[0], remote_coordinate[1])
+    if dist > convert_tolerance:
+        logging.warning(
+            "local converted coordinate of (%s, %s) is %.1fm away from amap: %s, %s" %
+            (gps_coordinate[0], gps_coordinate[1], dist, local_coordinate,
+             remote_coordinate))
+
+
+def split_chunks(items, size):
+    '''split list into chunks with max size.'''
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def convert_amap_coordinates(coordinates):
+    '''
+    convert gps coordinates to amap coordinates by batch.
+    return amap coordinates in dict, key is gps coordinate.
+    '''
+    if args.coord_convert == 'local':
+        return dict(zip(coordinates, wgs84_to_gcj02_batch(coordinates)))
+
+    # transform coordinates, in 'lon,lat' format.
+    locations = {}
+    missed = []
+    for gps_lat, gps_lon in coordinates:
+        cached = cache_get('amap_convert', gps_lat, gps_lon)
+        if cached is None:
+            missed.append((gps_lat, gps_lon))
+        else:
+            locations[(gps_lat, gps_lon)] = json.loads(cached)['locations']
+    for chunk in split_chunks(missed, amap_batch_convert_size):
+        url = amap_batch_coordinate_transformation_url % '|'.join(
+            ['%s,%s' % (gps_lon, gps_lat) for gps_lat, gps_lon in chunk])
+        transformed_coordinates = request_amap(url)
+        if transformed_coordinates is None:
+            # errors of batch requests are not told apart by coordinate.
+            for gps_lat, gps_lon in chunk:
+                set_resolve_error('amap', gps_lat, gps_lon)
+            continue
+        # locations in response are separated by ';'.
+        transformed_locations = transformed_coordinates['locations'].split(';')
+        for coordinate, location in zip(chunk, transformed_locations):
+            locations[coordinate] = location
+            cache_put('amap_convert', coordinate[0], coordinate[1],
+                      json.dumps({'status': '1', 'locations': location}))
+        for gps_lat, gps_lon in chunk[len(transformed_locations):]:
+            set_resolve_error('amap', gps_lat, gps_lon, 'amap_missing_result')
+
+    amap_coordinates = {}
+    for coordinate, location in locations.items():
+        amap_lon = round(float(location.split(',')[0]), 6)
+        amap_lat = round(float(location.split(',')[1]), 6)
+        amap_coordinates[coordinate] = (amap_lat, amap_lon)
+
+    if args.coord_convert == 'validate':
+        local_coordinates = wgs84_to_gcj02_batch(list(amap_coordinates.keys()))
+        for (coordinate, remote_coordinate), local_coordinate in zip(
+                amap_coordinates.items(), local_coordinates):
+            validate_converted(coordinate, local_coordinate, remote_coordinate)
+    return amap_coordinates
+
+
+def resolve_amap_addresses(coordinates):
+    '''
+    resolve gps coordinates by amap batch apis.
+    return address details in dict, key is coordinate, None if failed.
+    '''
+    coordinates = list(set(coordinates))
+    resolved = {coordinate: None for coordinate in coordinates}
+
+    # get address details.
+    amap_coordinates = []
+    for coordinate, amap_coordinate in convert_amap_coordinates(
+            coordinates).items():
+        amap_lat, amap_lon = amap_coordinate
+        cached = cache_get('amap_regeo', amap_lat, amap_lon)
+        if cached is None:
+            amap_coordinates.append((coordinate, amap_lat, amap_lon))
+        else:
+            resolved[coordinate] = json.loads(cached)
+    for chunk in split_chunks(amap_coordinates, amap_batch_resolve_size):
+        url = amap_batch_resolve_url % '|'.join(
+            ['%s,%s' % (amap_lon, amap_lat) for _, amap_lat, amap_lon in chunk])
+        address_details = request_amap(url)
+        if address_details is None:
+            # errors of batch requests are not told apart by coordinate.
+            for coordinate, _, _ in chunk:
+                set_resolve_error('amap', *coordinate)
+            continue
+        # regeocodes in response are in the same order as locations.
+        regeocodes = address_details['regeocodes']
+        for (coordinate, amap_lat, amap_lon), regeocode in zip(
+                chunk, regeocodes):
+            resolved[coordinate] = {'status': '1', 'regeocode': regeocode}
+            cache_put('amap_regeo', amap_lat, amap_lon,
+                      json.dumps(resolved[coordinate], ensure_ascii=False))
+        for coordinate, _, _ in chunk[len(regeocodes):]:
+            set_resolve_error('amap', *coordinate, 'amap_missing_result')
+    return resolved
+
+
+def update_address(session, batch_size, need_update_count, checkpoint,
+                   cursor):
+    '''
+    update address str by amap api, cursor is moved past all fetched
+    records, include failed ones.
+    return fetched and processed records count.
+    '''
     if len(args.key) == 0:
         logging.error("Amap key is not set.")
-        return 0
-
-    need_update_addresses = get_need_update_addresses(session, batch_size)
+        return 0, 0
+
+    need_update_addresses = get_need_update_addresses(session, batch_size,
+                                                      checkpoint,
+                                                      cursor['address'])
+    if len(need_update_addresses) > 0:
+        cursor['address'] = need_update_addresses[-1].id
+
+    coordinates = [(need_update_address.latitude,
+                    need_update_address.longitude)
+                   for need_update_address in need_update_addresses]
+    if args.amap_batch != 0:
+        # resolve all addresses by a few batch requests.
+        resolved = resolve_amap_addresses(coordinates)
+    else:
+        # request amap api concurrently if concurrency is set.
+        resolved = resolve_concurrently(resolve_amap_address, coordinates)
 
+    results = []
     for need_update_address in need_update_addresses:
+        coordinate = (need_update_address.latitude,
+                      need_update_address.longitude)
+        if coordinate in resolved:
+            address_details = resolved[coordinate]
+        else:
+            address_details = resolve_amap_address(*coordinate)
+        results.append([need_update_address, address_details, None])
+    errors = pop_resolve_errors('amap', coordinates)
+    for result in results:
+        if result[1] is None:
+            result[2] = errors.get((result[0].latitude, result[0].longitude),
+                                   'unknown')
+
+    processed_count, retry_ids = save_amap_addresses(session, results,
+                                                     need_update_count)
+    if len(retry_ids) > 0:
+        # progress is not saved past them.
+        cursor['retry_id'] = min(retry_ids + [cursor.get('retry_id',
+                                                         retry_ids[0])])
+    return len(need_update_addresses), processed_count
+
+
+def save_amap_addresses(session, results, need_update_count):
+    '''
+    update addresses by amap, results are lists of address, address details
+    and resolve error, address details is None if failed.
+    return processed records count, and ids of addresses failed by errors
+    which can be retried at once.
+    '''
+    processed_count = 0
+    fingerprints = []
+    errors = {}
+    for need_update_address, address_details, error in results:
         logging.info("processing update address (%d left)" %
                      (need_update_count - processed_count))
-        gps_lat = need_update_address.latitude
-        gps_lon = need_update_address.longitude
-
-        # transform coordinate
-        url = amap_coordinate_transformation_url % (args.key, gps_lon, gps_lat)
-        transformed_coordinate = request_amap_api(url)
-        if transformed_coordinate is None:
-            continue
-
-        locations = transformed_coordinate['locations']
-        amap_lon = round(float(locations.split(',')[0]), 6)
-        amap_lat = round(float(locations.split(',')[1]), 6)
-
-        # get address details
-        url = amap_resolve_url % (args.key, amap_lon, amap_lat)
-        address_details = request_amap_api(url)
         if address_details is None:
+            errors[need_update_address.id] = error
             continue
 
-        # update db
-        update_address_in_db(need_update_address, address_details)
+        # update db, unless address already has the amap result.
+        fingerprint, written = update_address_in_db(need_update_address,
+                                                    address_details)
+        fingerprints.append((need_update_address.id, fingerprint,
+                             need_update_address.updated_at))
+        metrics.inc('records_total', {
+            'mode': 'update',
+            'kind': 'address' if written else 'unchanged'
+        })
 
         processed_count += 1
+    save_fingerprints(session, fingerprints)
 
-    return processed_count
+    # failed addresses are not fetched again until due to retry, unless
+    # failed by network errors, rate limits or used up keys.
+    retry_ids = save_failures(session, 'address', errors)
+    clear_failures(session, 'address',
+                   [fingerprint[0] for fingerprint in fingerprints])
+    return processed_count, retry_ids
 
 
 def update_address_by_amap():
+    with Session(engine) as session:
+        logging.info("updating address by amap...")
+        # progress is saved in db, restart will not process records again.
+        # if language changed, teslamate will update all addresses, use
+        # RESET_CHECKPOINT to re-process all records.
+        checkpoint = load_checkpoint(session, amap_checkpoint)
+        need_update_count = get_update_record_count(session, checkpoint)
+    metrics.set('backlog', need_update_count, {'mode': 'update'})
+
+    cursor = {'address': 0}
+
+    def save_progress(session, watermark):
+        # if keys are used up in this batch, failed records are not skipped,
+        # neither records failed by errors which can be retried. with CLAIM,
+        # batches of other fixers may be not committed yet, progress is not
+        # saved, resolved addresses are skipped by fingerprints.
+        last_id = cursor['address']
+        if 'retry_id' in cursor:
+            last_id = min(last_id, cursor['retry_id'] - 1)
+        if amap_keys.available() and args.claim == 0:
+            save_checkpoint(session, amap_checkpoint,
+                            max(checkpoint['last_id'], last_id), watermark)
+
     while True:
+        if not amap_keys.available():
+            logging.warning("amap keys are used up, update later.")
+            break
         with Session(engine) as session:
-            logging.info("updating address by amap...")
-            need_update_count = get_update_record_count(session)
-            if update_address(session, args.batch, need_update_count) == 0:
-                # all recoreds are updated.
+            fetched_count, processed_count = update_address(
+                session, args.batch, need_update_count, checkpoint, cursor)
+            if fetched_count == 0:
+                # all recoreds are updated, addresses changed before this run
+                # are all processed.
+                save_progress(session, checkpoint['started_at'])
+                session.commit()
                 break
             else:
-                # commit at end of each batch.
+                # commit at end of each batch, with progress. watermark is
+                # not moved until all addresses are scanned, so a stopped run
+                # continues from the same place.
                 logging.info("saving...")
+                save_progress(session, checkpoint['watermark'])
                 session.commit()
+                amap_keys.save()
+                need_update_count -= processed_count
+                metrics.set('backlog', need_update_count, {'mode': 'update'})
 
 
-def main():
-    if args.mode == 0 or args.mode == 2:
+def run_pipeline(read, resolve, fail, write):
+    '''
+    run reader, resolving workers and writer concurrently, connected by
+    queues bounded by batch size.
+    read is a generator of records, resolve(record) requests map api for a
+    record, fail(record) is the result of a record which resolve raised,
+    write(results) saves a batch of results.
+    '''
+    read_queue = queue.Queue(maxsize=args.batch)
+    write_queue = queue.Queue(maxsize=args.batch)
+    metrics.set_function('queue_size', read_queue.qsize, {'stage': 'resolve'})
+    metrics.set_function('queue_size', write_queue.qsize, {'stage': 'write'})
+    worker_count = max(args.concurrency, 1)
+
+    def reader():
+        try:
+            for record in read():
+                read_queue.put(record)
+        except Exception:
+            logging.exception("read records failed.")
+        finally:
+            # one end mark for each worker.
+            for _ in range(worker_count):
+                read_queue.put(None)
+
+    def worker():
+        while True:
+            record = read_queue.get()
+            if record is None:
+                write_queue.put(None)
+                return
+            try:
+                result = resolve(record)
+            except Exception:
+                logging.exception("resolve record failed.")
+                # written as failed, so progress is not stuck.
+                result = fail(record)
+            write_queue.put(result)
+
+    threads = [Thread(target=reader, daemon=True)]
+    threads.extend(
+        Thread(target=worker, daemon=True) for _ in range(worker_count))
+    for thread in threads:
+        thread.start()
+
+    # writer, save results when batch is full or no more results for now.
+    results = []
+    finished_workers = 0
+    while finished_workers < worker_count:
+        try:
+            result = write_queue.get(timeout=pipeline_flush_interval)
+        except queue.Empty:
+            result = None
+        else:
+            if result is None:
+                finished_workers += 1
+            else:
+                results.append(result)
+        if len(results) >= args.batch or (result is None and len(results) > 0):
+            write(results)
+            results = []
+    if len(results) > 0:
+        write(results)
+
+
+def fix_empty_records_pipelined():
+    '''fix all empty records by pipeline.'''
+    with Session(engine) as session:
+        load_address_index(session)
+        logging.info("checking empty records...")
+        empty_count = get_empty_record_count(session)
+    progress = {'left': empty_count}
+    metrics.set('backlog', empty_count, {'mode': 'fix'})
+
+    def read():
+        # keyset pagination by id, a new session for every batch.
+        cursor = new_empty_cursor()
+        while True:
+            with Session(engine) as session:
+                drives, chargings = get_empty_records(session, args.batch,
+                                                      cursor)
+            if len(drives) + len(chargings) == 0:
+                return
+            for record in get_record_coordinates(drives, chargings):
+                yield record
+
+    def resolve(record):
+        kind, row, coordinates = record
+        return kind, row, coordinates, {
+            coordinate: resolve_osm_unknown(*coordinate)
+            for coordinate in coordinates
+        }
+
+    def fail(record):
+        kind, row, coordinates = record
+        for coordinate in coordinates:
+            set_resolve_error('osm', *coordinate, 'exception')
+        return kind, row, coordinates, {
+            coordinate: (None, None) for coordinate in coordinates
+        }
+
+    def write(results):
+        resolved = {}
+        for _, _, _, resolved_coordinates in results:
+            resolved.update(resolved_coordinates)
+        records = [(kind, row, coordinates)
+                   for kind, row, coordinates, _ in results]
+
+        with Session(engine) as session:
+            # get addresses, new addresses are added in one statement.
+            addresses = get_addresses(
+                session, [Position(*coordinate) for coordinate in resolved],
+                resolved)
+            errors = pop_resolve_errors('osm', resolved.keys())
+            progress['left'] -= link_records(session, records, addresses,
+                                             errors, progress['left'])
+            logging.info("saving...")
+            session.commit()
+            metrics.set('backlog', progress['left'], {'mode': 'fix'})
+
+    run_pipeline(read, resolve, fail, write)
+
+
+def update_address_pipelined():
+    '''update address str by amap api by pipeline.'''
+    if len(args.key) == 0:
+        logging.error("Amap key is not set.")
+        return
+
+    with Session(engine) as session:
+        logging.info("updating address by amap...")
+        checkpoint = load_checkpoint(session, amap_checkpoint)
+        need_update_count = get_update_record_count(session, checkpoint)
+    progress = {'left': need_update_count, 'last_id': checkpoint['last_id']}
+    metrics.set('backlog', need_update_count, {'mode': 'update'})
+    # ids in reading order, progress is saved only when all previous
+    # records are written.
+    issued_ids = deque()
+    written_ids = set()
+
+    def read():
+        # keyset pagination by id, a new session for every batch.
+        after_id = 0
+        while True:
+            if not amap_keys.available():
+                logging.warning("amap keys are used up, update later.")
+                return
+            with Session(engine) as session, profile_stage('query'):
+                need_update_addresses = filter_need_update(
+                    session.query(Addresses.id, Addresses.latitude,
+                                  Addresses.longitude), checkpoint)\
+                    .filter(Addresses.id > after_id)\
+                    .order_by(Addresses.id)\
+                    .limit(args.batch)\
+                    .all()
+            if len(need_update_addresses) == 0:
+                progress['finished'] = True
+                return
+            after_id = need_update_addresses[-1].id
+            for need_update_address in need_update_addresses:
+                issued_ids.append(need_update_address.id)
+                yield need_update_address
+
+    def resolve(need_update_address):
+        coordinate = (need_update_address.latitude,
+                      need_update_address.longitude)
+        address_details = resolve_amap_address(*coordinate)
+        error = None
+        if address_details is None:
+            error = pop_resolve_errors('amap', [coordinate]).get(
+                coordinate, 'unknown')
+        return need_update_address.id, address_details, error
+
+    def fail(need_update_address):
+        return need_update_address.id, None, 'exception'
+
+    def save_progress(session, watermark):
+        last_id = progress['last_id']
+        if 'retry_id' in progress:
+            last_id = max(checkpoint['last_id'],
+                          min(last_id, progress['retry_id'] - 1))
+        if amap_keys.available() and args.claim == 0:
+            save_checkpoint(session, amap_checkpoint, last_id, watermark)
+
+    def write(results):
+        resolved = {address_id: (address_details, error)
+                    for address_id, address_details, error in results}
+        with Session(engine) as session:
+            need_update_addresses = session\
+                .query(Addresses)\
+                .filter(Addresses.id.in_(list(resolved.keys())))\
+                .all()
+            processed_count, retry_ids = save_amap_addresses(
+                session, [[need_update_address] +
+                          list(resolved[need_update_address.id])
+                          for need_update_address in need_update_addresses],
+                progress['left'])
+            progress['left'] -= processed_count
+            if len(retry_ids) > 0:
+                progress['retry_id'] = min(
+                    retry_ids + [progress.get('retry_id', retry_ids[0])])
+
+            written_ids.update(resolved.keys())
+            while len(issued_ids) > 0 and issued_ids[0] in written_ids:
+                written_ids.discard(issued_ids[0])
+                progress['last_id'] = max(progress['last_id'],
+                                          issued_ids.popleft())
+            # commit at end of each batch, with progress. if keys are used
+            # up, failed records are not skipped, neither records failed by
+            # errors which can be retried. watermark is not moved until all
+            # addresses are scanned.
+            logging.info("saving...")
+            save_progress(session, checkpoint['watermark'])
+            session.commit()
+            amap_keys.save()
+            metrics.set('backlog', progress['left'], {'mode': 'update'})
+
+    run_pipeline(read, resolve, fail, write)
+    if progress.get('finished'):
+        # addresses changed before this run are all processed.
+        with Session(engine) as session:
+            save_progress(session, checkpoint['started_at'])
+            session.commit()
+
+
+def fix_records():
+    '''fix and update records by run mode.'''
+    if (args.mode == 0 or args.mode == 2) and args.group_precision != 0:
+        fix_grouped_records()
+    elif (args.mode == 0 or args.mode == 2) and args.pipeline != 0:
+        fix_empty_records_pipelined()
+    elif args.mode == 0 or args.mode == 2:
         fix_empty_records()
-    if args.mode == 1 or args.mode == 2:
+    if (args.mode == 1 or args.mode == 2) and args.pipeline != 0:
+        update_address_pipelined()
+    elif args.mode == 1 or args.mode == 2:
         update_address_by_amap()
 
+
+def install_trigger():
+    '''install triggers which notify daemon when records need to fix.'''
+    with engine.begin() as connection:
+        connection.execute(text('''
+            CREATE OR REPLACE FUNCTION %s() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('%s', TG_TABLE_NAME || ':' || NEW.id);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql''' % (notify_channel, notify_channel)))
+        for table, condition in notify_triggers:
+            connection.execute(
+                text("DROP TRIGGER IF EXISTS %s ON %s" %
+                     (notify_channel, table)))
+            connection.execute(
+                text('''CREATE TRIGGER %s AFTER %s ON %s FOR EACH ROW
+                        WHEN (%s) EXECUTE PROCEDURE %s()''' %
+                     (notify_channel, 'INSERT' if table == 'addresses' else
+                      'INSERT OR UPDATE', table, condition, notify_channel)))
+    logging.info("notify triggers installed.")
+
+
+def get_notified_ids(connection):
+    '''get ids of notified records, key is table name.'''
+    connection.poll()
+    ids = {table: set() for table, _ in notify_triggers}
+    while connection.notifies:
+        notify = connection.notifies.pop(0)
+        table, record_id = notify.payload.split(':')
+        if table in ids:
+            ids[table].add(int(record_id))
+    return ids
+
+
+def run_daemon():
+    '''fix records when notified by db, and check all records in every sweep.'''
+    if args.install_trigger != 0:
+        install_trigger()
+
+    listen_connection = engine.raw_connection()
+    connection = listen_connection.driver_connection
+    connection.autocommit = True
+    connection.cursor().execute("LISTEN %s" % notify_channel)
+    logging.info("listening on %s..." % notify_channel)
+
+    last_sweep = None
+    while True:
+        if last_sweep is None or \
+                time.monotonic() - last_sweep >= args.sweep:
+            # discard notifies, all records are checked.
+            get_notified_ids(connection)
+            fix_records()
+            last_sweep = time.monotonic()
+            continue
+
+        timeout = last_sweep + args.sweep - time.monotonic()
+        readable, _, _ = select_fd.select([connection], [], [], max(timeout, 0))
+        if len(readable) == 0:
+            continue
+        # wait for more notifies, records changed at the same time.
+        time.sleep(notify_delay)
+        ids = get_notified_ids(connection)
+        logging.info("notified: %d drives, %d chargings, %d addresses." %
+                     (len(ids['drives']), len(ids['charging_processes']),
+                      len(ids['addresses'])))
+        if (args.mode == 0 or args.mode == 2) and \
+                len(ids['drives']) + len(ids['charging_processes']) > 0:
+            fix_empty_records({
+                'drive': list(ids['drives']),
+                'charging': list(ids['charging_processes'])
+            })
+        # new addresses are added by teslamate or fixer.
+        if (args.mode == 1 or args.mode == 2) and len(ids['addresses']) > 0:
+            update_address_by_amap()
+
+
+def main():
+    if args.claim != 0 and args.pipeline != 0:
+        logging.warning("records are not locked in pipeline mode.")
+    start_profile()
+    # build offline index only.
+    if len(args.offline_build) > 0:
+        if len(args.offline_index) == 0:
+            logging.error("OFFLINE_INDEX is not set.")
+            return
+        build_offline_index(args.offline_build, args.offline_index)
+        return
+    load_offline_index()
+    init_db()
+    start_metrics_server()
     # wrong mode, do nothing and exit.
     if args.mode < 0 or args.mode > 2:
         logging.info("nothing to do, bye.")
+        return
+    # run as daemon, fix records when notified.
+    if args.daemon != 0:
+        run_daemon()
+        return
+
+    fix_records()
     # if interval is set, run in infinity mode.
-    elif args.interval != 0:
+    if args.interval != 0:
         loop_timer = Timer(args.interval, main)
         loop_timer.start()
 